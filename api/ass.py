@@ -0,0 +1,126 @@
+import os
+
+from api import config
+from api.compositor import AudioInput
+from api.metrics import span
+from api.progress import no_progress
+
+# Advanced SubStation Alpha colours are &HAABBGGRR
+white = "&H00FFFFFF"
+black = "&H00000000"
+blue = "&H00FF0000"
+
+style_fields = "Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding"
+event_fields = "Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text"
+
+def timestamp(t):
+    centiseconds = int(round(max(t, 0.0) * 100))
+    return f"{centiseconds // 360000}:{centiseconds // 6000 % 60:02d}:{centiseconds // 100 % 60:02d}.{centiseconds % 100:02d}"
+
+def escape(text):
+    # Braces start override blocks and can't be escaped
+    return text.replace("{", "(").replace("}", ")").replace("\n", "\\N")
+
+# ImageMagick font names like Meiryo-&-Meiryo-Italic-&-... are a list of faces, the first one is the family
+def font_family(font):
+    return font.split("-&-")[0]
+
+# Style line with the alignment of libass: 4 is middle left, 8 is top center
+def style_line(name, style, primary, secondary, alignment, margin_left=0):
+    fields = [
+        name, font_family(style['font']), style['fontsize'], primary, secondary, black, black,
+        0, 0, 0, 0, 100, 100, 0, 0, 1, style['stroke_width'], 0, alignment, margin_left, 0, 0, 1
+    ]
+    return "Style: " + ",".join(str(field) for field in fields)
+
+# Karaoke line where each word fills from white to blue while it is sung, the silences between words are empty syllables
+def karaoke_text(start, words, joiner):
+    parts = []
+    cursor = int(round(start * 100))
+    for i, (text, word_start, word_end) in enumerate(words):
+        word_start, word_end = int(round(word_start * 100)), int(round(word_end * 100))
+        if word_start > cursor:
+            parts.append(f"{{\\k{word_start - cursor}}}")
+        parts.append(f"{{\\kf{max(word_end - max(word_start, cursor), 0)}}}{escape(text.strip())}{joiner if i < len(words) - 1 else ''}")
+        cursor = max(word_end, cursor)
+    return "".join(parts)
+
+# Events of the window, moved so the window starts at 0
+def clip_events(events, window):
+    if window is None:
+        return events
+    start, end = window
+    return [(max(ta, start) - start, min(tb, end) - start, style, text) for ta, tb, style, text in events if ta < end and tb > start]
+
+# The lyrics of the layout as an ASS script, with the same placement as the rendered video: the sung line in the middle,
+# the furigana above it, the next line below and the translation at the top
+def build_ass(layout, window=None):
+    w, h = layout['video_size']
+    left, center = layout['base_position']
+    font_height = layout['font_height']
+    styles = layout['text_styles']
+    next_x, next_y = layout['next_line_position']
+
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {w}",
+        f"PlayResY: {h}",
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        f"Format: {style_fields}",
+        style_line("Lyrics", styles['subs'], blue, white, 4, left),
+        style_line("NextLine", styles['next_line'], white, white, 4, next_x),
+        style_line("Furigana", styles['furigana'], white, white, 4, left),
+        style_line("Translation", styles['translated'], white, white, 8),
+        "",
+        "[Events]",
+        f"Format: {event_fields}"
+    ]
+
+    # Positions are the vertical middle of the bands the video draws the text in.
+    # A line cut by the start of the window starts its karaoke there, with the words already sung filled at once.
+    window_start = window[0] if window else 0
+    events = []
+    for (ta, tb), words in layout['lines']:
+        events.append((ta, tb, "Lyrics", f"{{\\an4\\pos({left},{center + font_height // 2})}}" + karaoke_text(max(ta, window_start), words, layout['word_joiner'])))
+    for (ta, tb), text in layout['next_line']:
+        events.append((ta, tb, "NextLine", f"{{\\an4\\pos({next_x},{next_y + font_height // 2})}}" + escape(text)))
+    if layout['show_furigana']:
+        for (ta, tb), text in layout['furiganas']:
+            if text != "[pause]" and text.strip():
+                events.append((ta, tb, "Furigana", f"{{\\an4\\pos({left},{center - font_height // 4})}}" + escape(text)))
+    for (ta, tb), text in layout['translated_subs']:
+        if text != "[pause]":
+            events.append((ta, tb, "Translation", escape(text)))
+
+    for ta, tb, style, text in sorted(clip_events(events, window), key=lambda event: event[0]):
+        lines.append(f"Dialogue: 0,{timestamp(ta)},{timestamp(tb)},{style},,0,0,0,,{text}")
+    return "\n".join(lines) + "\n"
+
+# Mux the lyrics as a soft subtitles track with the audio over a still background, instead of drawing every frame.
+# The background is encoded at one frame per second, the subtitles are drawn by the player.
+def write_subtitled_video(layout, audio, video_filepath, preset='veryfast', progress=no_progress, window=None):
+    start, end = window or (0, layout['duration'])
+    w, h = layout['video_size']
+
+    # Also kept next to the video, to be used with another player or editor
+    subtitles_filepath = os.path.splitext(video_filepath)[0] + ".ass"
+    with span('build subtitles'):
+        with open(subtitles_filepath, "w", encoding="utf-8") as f:
+            f.write(build_ass(layout, window))
+
+    progress('encoding', 0)
+    with span('mux subtitles'):
+        command = [
+            config.ffmpeg_binary(), '-y', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', f"color=c=black:s={w}x{h}:r=1:d={end - start}",
+            '-i', subtitles_filepath
+        ]
+        audio_input = AudioInput(audio, start)
+        command += audio_input.arguments(2)
+        command += ['-map', '1:s', '-c:s', 'ass', '-c:v', 'libx264', '-tune', 'stillimage', '-preset', preset, '-pix_fmt', 'yuv420p', video_filepath]
+        audio_input.finish(audio_input.start(command), "mux the subtitles")
+    progress('encoding', 100)
@@ -0,0 +1,156 @@
+import json
+import os
+import subprocess
+
+import numpy as np
+import soundfile as sf
+import librosa
+
+from api import config
+
+# Bytes per sample of the uncompressed subtypes, used to check that the header matches the file size
+sample_sizes = {
+    'PCM_S8': 1, 'PCM_U8': 1, 'PCM_16': 2, 'PCM_24': 3, 'PCM_32': 4, 'FLOAT': 4, 'DOUBLE': 8
+}
+
+def metadata_path(filepath):
+    return f"{filepath}.meta.json"
+
+def file_signature(filepath):
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def probe_header(filepath):
+    try:
+        info = sf.info(filepath)
+    except Exception:
+        return None
+
+    if info.samplerate <= 0 or info.frames <= 0:
+        return None
+
+    # Streamed WAV files can have a placeholder data size, only trust the header if it matches the file size
+    sample_size = sample_sizes.get(info.subtype)
+    if sample_size is not None:
+        data_size = info.frames * info.channels * sample_size
+        file_size = os.path.getsize(filepath)
+        if data_size > file_size or file_size - data_size > 1024 * 1024:
+            return None
+
+    return {
+        'duration': info.frames / float(info.samplerate),
+        'samplerate': info.samplerate,
+        'channels': info.channels,
+        'frames': info.frames,
+        'format': info.format,
+        'subtype': info.subtype,
+        'source': 'header'
+    }
+
+def decode_metadata(filepath):
+    y, sr = librosa.load(filepath, sr=None, mono=False)
+    return {
+        'duration': librosa.get_duration(y=y, sr=sr),
+        'samplerate': sr,
+        'channels': 1 if y.ndim == 1 else y.shape[0],
+        'frames': y.shape[-1],
+        'format': None,
+        'subtype': None,
+        'source': 'decode'
+    }
+
+# Sidecar written by the separation stage so later stages don't need to open the audio at all
+def write_audio_metadata(filepath, metadata=None):
+    metadata = metadata or probe_header(filepath) or decode_metadata(filepath)
+    with open(metadata_path(filepath), "w") as f:
+        json.dump({**metadata, **file_signature(filepath)}, f)
+    return metadata
+
+def read_audio_metadata(filepath):
+    try:
+        with open(metadata_path(filepath), "r") as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Ignore the sidecar if the audio file was replaced after it was written
+    signature = file_signature(filepath)
+    if metadata.get('size') != signature['size'] or metadata.get('mtime') != signature['mtime']:
+        return None
+    metadata['source'] = 'sidecar'
+    return metadata
+
+# Duration and format of an audio file, only decoding it when neither the sidecar nor the header can be trusted
+def probe_audio(filepath):
+    return read_audio_metadata(filepath) or probe_header(filepath) or decode_metadata(filepath)
+
+# Cut points in the middle of the silent gaps, about chunk_seconds apart, so no word is split between two chunks.
+# Returns the (start, end) sample ranges of the chunks.
+def split_on_silence(samples, samplerate, chunk_seconds, top_db=40, min_silence=0.3):
+    chunk_length = int(chunk_seconds * samplerate)
+    if chunk_length <= 0 or len(samples) <= chunk_length:
+        return [(0, len(samples))]
+
+    intervals = librosa.effects.split(samples, top_db=top_db)
+    gaps = [(previous_end + start) // 2 for (_, previous_end), (start, _) in zip(intervals[:-1], intervals[1:]) if start - previous_end >= min_silence * samplerate]
+
+    cuts = []
+    chunk_start = 0
+    best = None
+    for cut in gaps:
+        if cut - chunk_start > chunk_length and best is not None:
+            cuts.append(best)
+            chunk_start = best
+            best = None
+        # Without any gap short enough, the chunk is cut at the first one after the limit
+        if best is None or cut - chunk_start <= chunk_length:
+            best = cut
+    if best is not None and len(samples) - chunk_start > chunk_length:
+        cuts.append(best)
+
+    bounds = [0] + [int(cut) for cut in cuts] + [len(samples)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Sample ranges where the vocals are active, the gaps shorter than min_silence are kept so the lines aren't cut
+def active_regions(samples, samplerate, top_db=40, min_silence=2.0, padding=0.5):
+    intervals = librosa.effects.split(samples, top_db=top_db)
+    pad = int(padding * samplerate)
+    regions = []
+    for start, end in intervals:
+        start, end = max(0, start - pad), min(len(samples), end + pad)
+        if regions and start - regions[-1][1] < min_silence * samplerate:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+    return [(int(start), int(end)) for start, end in regions]
+
+# Times in the audio made of the regions put end to end, mapped back to the original audio
+class RegionTimeline:
+    def __init__(self, regions, samplerate):
+        lengths = np.array([end - start for start, end in regions], dtype=np.float64) / samplerate
+        self.compact_starts = np.concatenate([[0.0], np.cumsum(lengths)[:-1]])
+        self.original_starts = np.array([start for start, _ in regions], dtype=np.float64) / samplerate
+        self.lengths = lengths
+
+    def original_time(self, t):
+        i = max(int(np.searchsorted(self.compact_starts, t, side='right')) - 1, 0)
+        return float(self.original_starts[i] + min(t - self.compact_starts[i], self.lengths[i]))
+
+# Decode any format ffmpeg reads into blocks of float32 samples, without ever holding the whole file in memory
+def stream_audio(filepath, samplerate, channels, block_frames):
+    command = [
+        config.ffmpeg_binary(), '-loglevel', 'error', '-i', filepath,
+        '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(channels), '-ar', str(samplerate), 'pipe:1'
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    block_bytes = block_frames * channels * 4
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % (channels * 4)], dtype=np.float32).reshape(-1, channels)
+    finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
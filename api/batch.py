@@ -0,0 +1,158 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+
+from flask import request, Blueprint
+from flask_cors import CORS
+
+from api.separate import allowed_file, upload_folder
+from api.youtube import is_youtube_link, download_youtube_audio
+from api.pipeline import separate_song, transcribe_song, render_song
+from api.render import render_profile
+from api.text_cache import text_cache
+from api.metrics import span
+from api.progress import InvalidRequest, JobCancelled, no_progress
+from api.jobs import run_job_and_respond
+
+batch = Blueprint('batch', __name__)
+CORS(batch)  # Enable CORS for cross-origin requests from the Next.js front end
+
+# Put in the queues between the stages after the last song
+end_of_batch = None
+
+# Read the request into the parameters of a batch job: several files and/or links, one per line in musicLinks
+def batch_params():
+    songs = []
+    for file in request.files.getlist('file'):
+        if file.filename == '' or not allowed_file(file.filename):
+            raise InvalidRequest(f"Unsupported file {file.filename}")
+        file.save(os.path.join(upload_folder, file.filename))
+        songs.append({'filename': file.filename})
+
+    links = request.form.getlist('musicLink') + request.form.get('musicLinks', '').splitlines()
+    for link in links:
+        link = link.strip()
+        if not link:
+            continue
+        if not is_youtube_link(link):
+            raise InvalidRequest(f"Invalid music link {link}")
+        songs.append({'music_link': link})
+
+    if not songs:
+        raise InvalidRequest('No music file or link in the request')
+    render_profile(request.form.get('profile'))
+    return {
+        'songs': songs,
+        'model_filename': request.form.get('model_filename'),
+        'alphabet': request.form.get('alphabet'),
+        'translation': request.form.get('translation'),
+        'whisper_model': request.form.get('whisper_model'),
+        'render_mode': request.form.get('render_mode'),
+        'profile': request.form.get('profile'),
+        'keep_intermediates': request.form.get('keep_intermediates', 'false').lower() in ('1', 'true', 'yes')
+    }
+
+# Takes the songs from the inbox, runs the stage on them and passes them on. A song that failed in an earlier stage
+# is passed on with its error, and nothing runs anymore once the job is cancelled.
+def run_batch_stage(name, function, inbox, outbox, busy_times, cancelled):
+    busy_time = 0.0
+    while True:
+        item = inbox.get()
+        if item is end_of_batch:
+            break
+        index, song, error = item
+        if error is None and not cancelled.is_set():
+            start = time.time()
+            try:
+                song = function(index, song)
+            except JobCancelled as e:
+                cancelled.set()
+                error = e
+            except Exception as e:
+                error = e
+            busy_time += time.time() - start
+        outbox.put((index, None if error else song, error))
+    busy_times[name] = busy_time
+    outbox.put(end_of_batch)
+
+# Separate, transcribe and render many songs, with the stages overlapped: while a song is rendered the next one is
+# transcribed and the one after is separated. The stages run in threads of this process so every song uses the same
+# loaded separators and Whisper models, and the queues between them only hold one song to bound the memory used.
+def run_batch(params, progress=no_progress):
+    batch_start = time.time()
+    text_cache_start = text_cache.stats()
+    songs = params['songs']
+    keep_intermediates = params.get('keep_intermediates', False)
+    finished = []
+    cancelled = threading.Event()
+
+    def song_progress(index):
+        def report(step, percent=None):
+            progress(f"song {index + 1}/{len(songs)}: {step}", 100.0 * len(finished) / len(songs))
+        return report
+
+    def separate_stage(index, song):
+        filename, base_filename = song.get('filename'), None
+        if 'music_link' in song:
+            song_progress(index)('downloading', 0)
+            with span('download'):
+                filename, base_filename = download_youtube_audio(song['music_link'])
+        return separate_song(filename, params['model_filename'], keep_intermediates, base_filename, song_progress(index))
+
+    def transcribe_stage(index, song):
+        return transcribe_song(song, params.get('whisper_model'), keep_intermediates, song_progress(index))
+
+    def render_stage(index, song):
+        return render_song(song, params['alphabet'], params['translation'], params.get('render_mode'), params.get('profile'), song_progress(index))
+
+    inbox = queue.Queue()
+    for index, song in enumerate(songs):
+        inbox.put((index, song, None))
+    inbox.put(end_of_batch)
+
+    queues = [inbox, queue.Queue(maxsize=1), queue.Queue(maxsize=1), queue.Queue()]
+    busy_times = {}
+    threads = []
+    for i, (name, function) in enumerate([('separate', separate_stage), ('transcribe', transcribe_stage), ('render', render_stage)]):
+        # Each thread runs in a copy of the job's context so the stage spans are part of its trace
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(run_batch_stage, name, function, queues[i], queues[i + 1], busy_times, cancelled), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    results = [None] * len(songs)
+    while True:
+        item = queues[-1].get()
+        if item is end_of_batch:
+            break
+        index, song, error = item
+        source = songs[index].get('filename') or songs[index].get('music_link')
+        results[index] = {'source': source, 'error': str(error)} if error else {'source': source, **song['result']}
+        finished.append(index)
+        if not cancelled.is_set():
+            try:
+                progress(f"{len(finished)}/{len(songs)} songs done", 100.0 * len(finished) / len(songs))
+            except JobCancelled:
+                cancelled.set()
+    for thread in threads:
+        thread.join()
+    if cancelled.is_set():
+        raise JobCancelled()
+
+    total_time = time.time() - batch_start
+    completed = sum(1 for result in results if 'error' not in result)
+    return {
+        'songs': results,
+        'completed': completed,
+        'failed': len(songs) - completed,
+        'total_time': total_time,
+        'songs_per_hour': 3600.0 * completed / total_time if total_time > 0 else 0.0,
+        'stage_busy_time': busy_times,
+        'text_cache': text_cache.stats(since=text_cache_start)
+    }
+
+@batch.route('/api/batch', methods=['POST'])
+def batch_songs():
+    return run_job_and_respond('batch')
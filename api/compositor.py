@@ -0,0 +1,427 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from api import config
+from api.timeline import HighlightTimeline
+from api.text_cache import rasterize_text
+from api.progress import no_progress
+from api.metrics import span, record_span
+
+# A list of [((ta, tb), text), ...] subtitles with the line displayed at a given time, like SubtitlesClip
+class SubtitleTrack:
+    def __init__(self, subtitles):
+        self.starts = np.array([float(ta) for (ta, tb), txt in subtitles], dtype=np.float64)
+        self.ends = np.array([float(tb) for (ta, tb), txt in subtitles], dtype=np.float64)
+        self.texts = [txt for (ta, tb), txt in subtitles]
+
+    def text_at(self, t):
+        # SubtitlesClip displays the first subtitle of the list that is active at time t
+        active = np.flatnonzero((self.starts <= t) & (t < self.ends))
+        return self.texts[active[0]] if len(active) > 0 else None
+
+# Lyrics drawn as holes in a white layer, showing the black background or the blue rectangle underneath
+class MaskTrack(SubtitleTrack):
+    def __init__(self, subtitles, style, position, size):
+        super().__init__(subtitles)
+        self.position = position
+        self.size = size
+
+        # Pre-rasterize every line once: the blended value is the same as moviepy's blit, truncated to uint8
+        self.patches = {None: self.make_patch(np.zeros((size[1], size[0])))}
+        for txt in set(self.texts):
+            frame, _ = rasterize_text(txt, style)
+            mask = np.zeros((size[1], size[0]))
+            h = min(size[1], frame.shape[0])
+            w = min(size[0], frame.shape[1])
+            mask[:h, :w] = 1.0 * frame[:h, :w, 0] / 255
+            self.patches[txt] = self.make_patch(mask)
+
+    @staticmethod
+    def make_patch(mask):
+        # Value over black, and value of the blue channel over the blue rectangle
+        over_black = (255.0 * mask).astype(np.uint8)
+        over_blue = (255.0 * mask + (1.0 - mask) * 255).astype(np.uint8)
+        return over_black, over_blue
+
+    def draw(self, frame, t, rect_x):
+        over_black, over_blue = self.patches[self.text_at(t)]
+        x, y = self.position
+        w, h = self.size
+        region = frame[y:y + h, x:x + w]
+        cut = min(max(rect_x - x, 0), w)
+
+        region[:, :, 0] = over_black
+        region[:, :, 1] = over_black
+        region[:, :cut, 2] = over_blue[:, :cut]
+        region[:, cut:, 2] = over_black[:, cut:]
+
+# Text images pasted over the frame (next line and translation)
+class ImageTrack(SubtitleTrack):
+    def __init__(self, subtitles, style, position, video_size):
+        super().__init__(subtitles)
+        self.position = position
+        self.video_size = video_size
+
+        self.images = {}
+        for txt in set(self.texts):
+            frame, mask = rasterize_text(txt, style)
+            self.images[txt] = (frame, None if mask is None else np.dstack(3 * [mask]))
+
+    def box(self, image):
+        # Visible part of the image once placed on the frame, as (frame slices, image slices)
+        h, w = image.shape[:2]
+        x, y = self.position
+        if x == "center":
+            x = int((self.video_size[0] - w) / 2)
+        if y == "top":
+            y = 0
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.video_size[0]), min(y + h, self.video_size[1])
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (slice(y0, y1), slice(x0, x1)), (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+
+    def draw(self, frame, t):
+        txt = self.text_at(t)
+        if txt is None:
+            return None
+        image, mask = self.images[txt]
+        box = self.box(image)
+        if box is None:
+            return None
+        frame_box, image_box = box
+        if mask is None:
+            frame[frame_box] = image[image_box]
+        else:
+            m = mask[image_box]
+            frame[frame_box] = (m * image[image_box] + (1.0 - m) * frame[frame_box]).astype(np.uint8)
+        return frame_box
+
+# Builds the karaoke frames directly with NumPy instead of stacking moviepy layers
+class KaraokeCompositor:
+    def __init__(self, layout):
+        self.video_size = layout["video_size"]
+        self.fps = layout["fps"]
+        self.duration = layout["duration"]
+        self.nb_frames = int(np.ceil(self.duration * self.fps))
+        self.timeline = HighlightTimeline.from_dicts(layout["rect_dict_list"])
+
+        w, h = self.video_size
+        left, center = layout["base_position"]
+        font_height = layout["font_height"]
+        styles = layout["text_styles"]
+
+        self.mask_tracks = [MaskTrack(layout["subs"], styles["subs"], (left, center), (w - left, font_height))]
+        if layout["show_furigana"]:
+            self.mask_tracks.append(MaskTrack(layout["furiganas"], styles["furigana"], (left, center - font_height // 2), (w - left, font_height // 2)))
+
+        self.image_tracks = [ImageTrack(layout["next_line"], styles["next_line"], layout["next_line_position"], self.video_size)]
+        if layout["translated_subs"]:
+            self.image_tracks.append(ImageTrack(layout["translated_subs"], styles["translated"], ("center", "top"), self.video_size))
+
+        # Everything outside the lyrics band is covered by the white rectangles, so the frame starts white
+        self.background = np.full((h, w, 3), 255, dtype=np.uint8)
+        self.frame_buffer = self.background.copy()
+        self.dirty_boxes = []
+
+    def make_frame(self, frame_index):
+        frame = self.frame_buffer
+        for box in self.dirty_boxes:
+            frame[box] = self.background[box]
+        self.dirty_boxes = []
+
+        t = frame_index / float(self.fps)
+        rect_x = int(self.timeline.x_at_frame(frame_index, self.fps))
+        for track in self.mask_tracks:
+            track.draw(frame, t, rect_x)
+        for track in self.image_tracks:
+            box = track.draw(frame, t)
+            if box is not None:
+                self.dirty_boxes.append(box)
+
+        return frame
+
+    # The audio is either a file path or a (samples, samplerate) array already in memory.
+    # Fragmented files can be played while they are written, with a fragment starting on each keyframe.
+    def write_videofile(self, filepath, audio, preset='veryfast', first_frame=0, last_frame=None, progress=no_progress, fragmented=False):
+        last_frame = self.nb_frames if last_frame is None else last_frame
+        w, h = self.video_size
+        command = [
+            config.ffmpeg_binary(), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo', '-s', f'{w}x{h}', '-pix_fmt', 'rgb24', '-r', str(self.fps), '-i', '-'
+        ]
+
+        audio_input = AudioInput(audio, first_frame / float(self.fps))
+        command += audio_input.arguments(1)
+        command += ['-c:v', 'libx264', '-preset', preset, '-pix_fmt', 'yuv420p']
+        if fragmented:
+            keyframe_interval = max(int(round(config.STREAM_FRAGMENT_SECONDS * self.fps)), 1)
+            command += ['-g', str(keyframe_interval), '-keyint_min', str(keyframe_interval), '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4']
+        command.append(filepath)
+
+        process = audio_input.start(command, stdin=subprocess.PIPE)
+        # Drawing and encoding are interleaved, the time blocked writing to ffmpeg is the time spent encoding
+        compose_time = 0.0
+        encode_time = 0.0
+        try:
+            for i in range(first_frame, last_frame):
+                start = time.perf_counter()
+                frame = self.make_frame(i)
+                drawn = time.perf_counter()
+                process.stdin.write(frame.data)
+                compose_time += drawn - start
+                encode_time += time.perf_counter() - drawn
+                if (i - first_frame) % self.fps == 0:
+                    progress('encoding', 100 * (i - first_frame) / max(last_frame - first_frame, 1))
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            # Cancelled or failed while drawing, don't leave ffmpeg waiting for frames
+            process.kill()
+            process.wait()
+            raise
+        start = time.perf_counter()
+        audio_input.finish(process, "encode the video")
+        record_span('compose', compose_time, frames=last_frame - first_frame)
+        record_span('encode', encode_time + time.perf_counter() - start, frames=last_frame - first_frame)
+
+# Audio track of the video, either a file path or a (samples, samplerate) array already in memory, from start seconds
+class AudioInput:
+    def __init__(self, audio, start=0.0):
+        self.audio = audio
+        self.start_time = start
+        self.pipe = None
+        self.samples = None
+        self.writer = None
+
+    def arguments(self, input_index):
+        if self.audio is None:
+            return []
+        if isinstance(self.audio, str):
+            command = ['-ss', str(self.start_time), '-i', self.audio]
+        else:
+            # In-memory audio is streamed to ffmpeg through an extra pipe instead of a temporary file
+            samples, samplerate = self.audio
+            self.samples = np.ascontiguousarray(samples[int(self.start_time * samplerate):], dtype=np.float32)
+            self.pipe = os.pipe()
+            command = ['-f', 'f32le', '-ar', str(samplerate), '-ac', str(self.samples.shape[1] if self.samples.ndim > 1 else 1), '-i', f'pipe:{self.pipe[0]}']
+        return command + ['-map', '0:v', '-map', f'{input_index}:a', '-c:a', 'aac', '-shortest']
+
+    def start(self, command, stdin=None):
+        process = subprocess.Popen(command, stdin=stdin, stderr=subprocess.PIPE, pass_fds=self.pipe[:1] if self.pipe else ())
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            self.writer = threading.Thread(target=write_and_close, args=(self.pipe[1], self.samples), daemon=True)
+            self.writer.start()
+        return process
+
+    def finish(self, process, action):
+        error = process.stderr.read().decode("utf-8", errors="replace")
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to {action}: {error.strip()}")
+        if self.writer is not None:
+            self.writer.join()
+
+def write_and_close(fd, samples):
+    try:
+        with open(fd, 'wb') as f:
+            f.write(memoryview(samples).cast('B'))
+    except BrokenPipeError:
+        # ffmpeg stops reading the audio once the video ends
+        pass
+
+# Frame ranges of about the same length for each part, cut where a "[pause]" starts so no lyric line is split
+def split_frames(layout, nb_frames, parts, first_frame=0):
+    fps = layout["fps"]
+    length = nb_frames - first_frame
+    pauses = sorted({int(np.ceil(ta * fps)) for (ta, tb), txt in layout["subs"] if txt == "[pause]" and first_frame < ta * fps < nb_frames})
+    cuts = []
+    for k in range(1, parts):
+        target = first_frame + k * length // parts
+        cut = min(pauses, key=lambda frame: abs(frame - target)) if pauses else target
+        # Without a pause close enough, cut in the middle of a line (the frames don't depend on each other)
+        if abs(cut - target) > length // (2 * parts):
+            cut = target
+        if cut > (cuts[-1] if cuts else first_frame):
+            cuts.append(cut)
+    bounds = [first_frame] + cuts + [nb_frames]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Join the encoded parts without re-encoding them with ffmpeg's concat demuxer, and add the audio once from start seconds
+def join_parts(part_filepaths, audio, video_filepath, list_filepath, start=0.0):
+    with span('join parts', parts=len(part_filepaths)):
+        with open(list_filepath, "w") as f:
+            for filepath in part_filepaths:
+                f.write(f"file '{os.path.abspath(filepath)}'\n")
+
+        command = [config.ffmpeg_binary(), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_filepath]
+        audio_input = AudioInput(audio, start)
+        command += audio_input.arguments(1)
+        command += ['-c:v', 'copy', video_filepath]
+        audio_input.finish(audio_input.start(command), "join the video parts")
+
+# Render processes, kept between renders so they don't import moviepy and numpy again
+render_executors = {}
+render_executors_lock = threading.Lock()
+
+def render_executor(workers):
+    with render_executors_lock:
+        if workers not in render_executors:
+            render_executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return render_executors[workers]
+
+# Runs in a render process, the part has no audio
+def render_part(layout, filepath, first_frame, last_frame, preset):
+    KaraokeCompositor(layout).write_videofile(filepath, None, preset=preset, first_frame=first_frame, last_frame=last_frame)
+    return last_frame - first_frame
+
+# Render the parts of the video at the same time, then join them without re-encoding and add the audio once
+def render_video_parallel(layout, audio, video_filepath, workers, preset='veryfast', progress=no_progress, frames=None):
+    first_frame, last_frame = frames or (0, int(np.ceil(layout["duration"] * layout["fps"])))
+    nb_frames = last_frame - first_frame
+    ranges = split_frames(layout, last_frame, workers, first_frame)
+    parts_folder = f"{video_filepath}.parts"
+    os.makedirs(parts_folder, exist_ok=True)
+    part_filepaths = [os.path.join(parts_folder, f"part{i}.mp4") for i in range(len(ranges))]
+
+    executor = render_executor(workers)
+    futures = [executor.submit(render_part, layout, filepath, first, last, preset) for filepath, (first, last) in zip(part_filepaths, ranges)]
+    try:
+        with span('render parts', parts=len(ranges), frames=nb_frames):
+            done_frames = 0
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    done_frames += future.result()
+                # Also called while waiting so a cancelled job stops here
+                progress('encoding', 100 * done_frames / max(nb_frames, 1))
+
+        progress('joining parts', 100)
+        join_parts(part_filepaths, audio, video_filepath, os.path.join(parts_folder, "parts.txt"), first_frame / float(layout["fps"]))
+    finally:
+        for future in futures:
+            future.cancel()
+        shutil.rmtree(parts_folder, ignore_errors=True)
+
+# Everything that changes all the frames: with a different value none of the previous parts can be reused
+def settings_hash(layout, preset):
+    keys = ['video_size', 'fps', 'base_position', 'font_height', 'left_margin', 'next_line_position', 'show_furigana', 'text_styles']
+    settings = {key: layout[key] for key in keys}
+    settings['preset'] = preset
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+# What is drawn in a range of frames: the highlight position of each frame and the subtitles shown during the range
+def part_hash(layout, timeline, first_frame, last_frame):
+    fps = float(layout["fps"])
+    start, end = first_frame / fps, last_frame / fps
+    digest = hashlib.sha256(timeline.frame_positions(fps, first_frame, last_frame).astype(np.int64).tobytes())
+    for key in ('subs', 'next_line', 'furiganas', 'translated_subs'):
+        shown = [[ta, tb, txt] for (ta, tb), txt in layout[key] if ta <= end and tb > start]
+        digest.update(json.dumps([key, shown]).encode("utf-8"))
+    return digest.hexdigest()
+
+def read_manifest(filepath):
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Keep the encoded parts of the video with a manifest of what they show, and on the next render of the same video only
+# re-encode the parts whose lyrics or highlight changed. The parts are independent encodes that start on a keyframe,
+# so the new and the untouched ones are joined without re-encoding.
+def render_video_incremental(layout, audio, video_filepath, preset='veryfast', progress=no_progress, workers=None):
+    fps = layout["fps"]
+    nb_frames = int(np.ceil(layout["duration"] * fps))
+    parts_folder = os.path.join(config.RENDER_PARTS_FOLDER, os.path.basename(video_filepath))
+    manifest_filepath = os.path.join(parts_folder, "manifest.json")
+    os.makedirs(parts_folder, exist_ok=True)
+
+    # The previous cuts are kept when possible, a lyric edit that moves a pause doesn't move the parts around it
+    settings = settings_hash(layout, preset)
+    manifest = read_manifest(manifest_filepath)
+    if manifest is not None and manifest['settings'] == settings and manifest['nb_frames'] == nb_frames:
+        ranges = [(part['first_frame'], part['last_frame']) for part in manifest['parts']]
+        previous = {(part['first_frame'], part['last_frame']): part for part in manifest['parts']}
+    else:
+        ranges = split_frames(layout, nb_frames, max(1, int(np.ceil(layout["duration"] / config.RENDER_PART_SECONDS))))
+        previous = {}
+
+    timeline = HighlightTimeline.from_dicts(layout["rect_dict_list"])
+    parts = []
+    stale = []
+    with span('compare parts', parts=len(ranges)):
+        for first, last in ranges:
+            digest = part_hash(layout, timeline, first, last)
+            part = {'first_frame': first, 'last_frame': last, 'hash': digest, 'filename': f"part{first}_{digest[:16]}.mp4"}
+            old = previous.get((first, last))
+            if old is None or old['hash'] != digest or not os.path.exists(os.path.join(parts_folder, old['filename'])):
+                stale.append(part)
+            parts.append(part)
+
+    stale_frames = sum(part['last_frame'] - part['first_frame'] for part in stale)
+    workers = min(config.RENDER_WORKERS if workers is None else workers, len(stale))
+    with span('render parts', parts=len(stale), frames=stale_frames):
+        done_frames = 0
+        if workers > 1:
+            executor = render_executor(workers)
+            futures = [executor.submit(render_part, layout, os.path.join(parts_folder, part['filename']), part['first_frame'], part['last_frame'], preset) for part in stale]
+            try:
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_frames += future.result()
+                    progress('encoding', 100 * done_frames / max(stale_frames, 1))
+            finally:
+                for future in futures:
+                    future.cancel()
+        elif stale:
+            # One compositor for all the parts so the lyrics are only rasterized once
+            with span('prepare tracks'):
+                karaoke = KaraokeCompositor(layout)
+            for part in stale:
+                karaoke.write_videofile(os.path.join(parts_folder, part['filename']), None, preset=preset, first_frame=part['first_frame'], last_frame=part['last_frame'])
+                done_frames += part['last_frame'] - part['first_frame']
+                progress('encoding', 100 * done_frames / max(stale_frames, 1))
+
+    progress('joining parts', 100)
+    join_parts([os.path.join(parts_folder, part['filename']) for part in parts], audio, video_filepath, os.path.join(parts_folder, "parts.txt"))
+
+    with open(manifest_filepath, "w", encoding="utf-8") as f:
+        json.dump({'settings': settings, 'nb_frames': nb_frames, 'parts': parts}, f)
+    # The replaced parts aren't needed anymore
+    kept = {part['filename'] for part in parts}
+    for filename in os.listdir(parts_folder):
+        if filename.endswith(".mp4") and filename not in kept:
+            os.remove(os.path.join(parts_folder, filename))
+
+    return {'parts': len(parts), 'rendered_parts': len(stale), 'rendered_frames': stale_frames}
+
+# The window is the (start, end) seconds of the song to render, all of it by default.
+# A streamed video is written in one pass as a fragmented MP4, so it can be played from the start while it is rendered.
+def render_video(layout, audio, video_filepath, preset='veryfast', progress=no_progress, workers=None, window=None, stream=False):
+    fps = layout["fps"]
+    start, end = window or (0, layout["duration"])
+    frames = (int(start * fps), int(np.ceil(min(end, layout["duration"]) * fps)))
+
+    workers = config.RENDER_WORKERS if workers is None else workers
+    # Parts shorter than ten seconds aren't worth starting a process for
+    workers = min(workers, int((frames[1] - frames[0]) / fps // 10))
+    if workers > 1 and not stream:
+        render_video_parallel(layout, audio, video_filepath, workers, preset=preset, progress=progress, frames=frames)
+    else:
+        with span('prepare tracks'):
+            compositor = KaraokeCompositor(layout)
+        compositor.write_videofile(video_filepath, audio, preset=preset, first_frame=frames[0], last_frame=frames[1], progress=progress, fragmented=stream)
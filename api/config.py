@@ -0,0 +1,91 @@
+import os
+
+# Settings shared by the api modules, they can be overridden with environment variables
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+def env_str(name, default):
+    value = os.environ.get(name)
+    return value if value not in (None, "") else default
+
+cache_folder = os.path.join('output/', 'cache/')
+
+# Rendered text bitmaps cache
+TEXT_CACHE_FOLDER = env_str("KARAOK_TEXT_CACHE_FOLDER", os.path.join(cache_folder, 'text/'))
+TEXT_CACHE_MEMORY_MB = env_int("KARAOK_TEXT_CACHE_MEMORY_MB", 256)
+TEXT_CACHE_DISK_MB = env_int("KARAOK_TEXT_CACHE_DISK_MB", 1024)
+
+# Use the same ffmpeg executable as moviepy so every stage runs the one installed with it
+def ffmpeg_binary():
+    try:
+        from moviepy.config import get_setting
+        return get_setting("FFMPEG_BINARY")
+    except ImportError:
+        return env_str("FFMPEG_BINARY", "ffmpeg")
+
+# Video rendering: "compositor" streams frames to ffmpeg, "moviepy" uses the CompositeVideoClip layer stack
+RENDER_MODE = env_str("KARAOK_RENDER_MODE", "compositor")
+# Default render profile, "full" (1280x720, 24 fps) or "preview" (426x240, 10 fps, ultrafast preset)
+RENDER_PROFILE = env_str("KARAOK_RENDER_PROFILE", "full")
+
+# Whisper models kept loaded between requests
+WHISPER_MODEL = env_str("KARAOK_WHISPER_MODEL", "medium")
+WHISPER_MEMORY_BUDGET_MB = env_int("KARAOK_WHISPER_MEMORY_BUDGET_MB", 8192)
+WHISPER_PRELOAD = [size for size in env_str("KARAOK_WHISPER_PRELOAD", "").split(",") if size]
+
+# Loaded audio separators kept between requests
+SEPARATOR_POOL_SIZE = env_int("KARAOK_SEPARATOR_POOL_SIZE", 4)
+SEPARATOR_POOL_PER_MODEL = env_int("KARAOK_SEPARATOR_POOL_PER_MODEL", 2)
+SEPARATOR_IDLE_TIMEOUT = env_float("KARAOK_SEPARATOR_IDLE_TIMEOUT", 600)
+
+# Background jobs running the separation, transcription and render stages
+JOB_WORKERS = env_int("KARAOK_JOB_WORKERS", 2)
+JOB_EXECUTOR = env_str("KARAOK_JOB_EXECUTOR", "process")
+JOB_RETENTION = env_float("KARAOK_JOB_RETENTION", 3600)
+
+# Separation and transcription results reused when the same audio is submitted again
+STAGE_CACHE_FOLDER = env_str("KARAOK_STAGE_CACHE_FOLDER", os.path.join(cache_folder, 'stages/'))
+STAGE_CACHE_MB = env_int("KARAOK_STAGE_CACHE_MB", 10240)
+
+# Lyrics translation: "google" or "loopback" (returns the lyrics unchanged, to run without network)
+TRANSLATION_BACKEND = env_str("KARAOK_TRANSLATION_BACKEND", "google")
+TRANSLATION_BATCH_SIZE = env_int("KARAOK_TRANSLATION_BATCH_SIZE", 20)
+TRANSLATION_WORKERS = env_int("KARAOK_TRANSLATION_WORKERS", 4)
+TRANSLATION_CACHE_SIZE = env_int("KARAOK_TRANSLATION_CACHE_SIZE", 10000)
+
+# Parallel transcription: with more than one worker the vocals are cut at silent gaps into chunks of about
+# KARAOK_TRANSCRIBE_CHUNK_SECONDS, transcribed at the same time by a pool of processes
+TRANSCRIBE_WORKERS = env_int("KARAOK_TRANSCRIBE_WORKERS", 1)
+TRANSCRIBE_CHUNK_SECONDS = env_float("KARAOK_TRANSCRIBE_CHUNK_SECONDS", 60)
+
+# Voice activity pre-pass: "energy" only transcribes the parts of the vocals louder than KARAOK_VAD_TOP_DB below
+# the peak, with quieter gaps shorter than KARAOK_VAD_MIN_SILENCE seconds kept. "off" transcribes the whole stem.
+VAD = env_str("KARAOK_VAD", "energy")
+VAD_TOP_DB = env_float("KARAOK_VAD_TOP_DB", 40)
+VAD_MIN_SILENCE = env_float("KARAOK_VAD_MIN_SILENCE", 2.0)
+VAD_PADDING = env_float("KARAOK_VAD_PADDING", 0.5)
+
+# Files longer than KARAOK_SEPARATION_CHUNK_SECONDS are separated window by window so memory doesn't grow with their
+# length, consecutive windows share KARAOK_SEPARATION_OVERLAP_SECONDS of audio that is crossfaded. 0 disables it.
+SEPARATION_CHUNK_SECONDS = env_float("KARAOK_SEPARATION_CHUNK_SECONDS", 600)
+SEPARATION_OVERLAP_SECONDS = env_float("KARAOK_SEPARATION_OVERLAP_SECONDS", 5)
+
+# Number of processes rendering parts of the video at the same time in the compositor mode, 1 renders it in one pass
+RENDER_WORKERS = env_int("KARAOK_RENDER_WORKERS", 1)
+
+# Incremental renders keep the video in parts of about KARAOK_RENDER_PART_SECONDS, only the parts whose lyrics changed
+# are encoded again on the next render of the same video
+RENDER_PARTS_FOLDER = env_str("KARAOK_RENDER_PARTS_FOLDER", os.path.join(cache_folder, 'renders/'))
+RENDER_PART_SECONDS = env_float("KARAOK_RENDER_PART_SECONDS", 30)
+
+# Streamed renders are written as fragmented MP4 with a fragment every KARAOK_STREAM_FRAGMENT_SECONDS. The stream endpoint
+# checks for new data every KARAOK_STREAM_POLL_INTERVAL seconds and gives up after KARAOK_STREAM_IDLE_TIMEOUT without any.
+STREAM_FRAGMENT_SECONDS = env_float("KARAOK_STREAM_FRAGMENT_SECONDS", 2)
+STREAM_POLL_INTERVAL = env_float("KARAOK_STREAM_POLL_INTERVAL", 0.25)
+STREAM_IDLE_TIMEOUT = env_float("KARAOK_STREAM_IDLE_TIMEOUT", 60)
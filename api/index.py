@@ -4,9 +4,27 @@ from flask_cors import CORS
 from api.separate import separate
 from api.transcribe import transcribe
 from api.render import render
+from api.pipeline import pipeline
+from api.batch import batch
+from api.jobs import jobs, job_manager
+from api.stream import stream
+from api.metrics import metrics
+from api.models import preload_models
+from api import config
 
 app = Flask(__name__)
 CORS(app)
 app.register_blueprint(separate)
 app.register_blueprint(transcribe)
-app.register_blueprint(render)
\ No newline at end of file
+app.register_blueprint(render)
+app.register_blueprint(pipeline)
+app.register_blueprint(batch)
+app.register_blueprint(jobs)
+app.register_blueprint(stream)
+app.register_blueprint(metrics)
+
+# With process workers the models are preloaded in each worker instead, the workers are started with the server
+if config.JOB_EXECUTOR != "process":
+    preload_models()
+else:
+    job_manager.start()
@@ -0,0 +1,128 @@
+from collections import namedtuple
+from functools import lru_cache
+
+import pykakasi
+
+# One reading of the converted text, as returned by pykakasi for each morpheme
+Morpheme = namedtuple('Morpheme', ['orig', 'hira', 'kana', 'hepburn'])
+
+# Loading the kakasi dictionaries is slow, every conversion shares the same converter
+@lru_cache(maxsize=None)
+def converter():
+    return pykakasi.kakasi()
+
+# Chorus lines come back several times in a song, their conversion is only done once
+@lru_cache(maxsize=4096)
+def readings(text):
+    return tuple(Morpheme(item['orig'], item['hira'], item['kana'], item['hepburn']) for item in converter().convert(text))
+
+def contains_kanji(text):
+    return any(0x4E00 <= ord(char) <= 0x9FBF for char in text)
+
+def romaji(text):
+    return "".join(morpheme.hepburn for morpheme in readings(text))
+
+# Function to create 2 lists, one with the kanji and one with the furigana. They're matched by index.
+def get_furigana_mapping(text):
+    kanji_list = []
+    furigana_list = []
+
+    for morpheme in readings(text):
+        orig = morpheme.orig
+        hira = morpheme.hira
+        if orig != hira and orig != morpheme.kana:
+            while orig and hira and orig[-1] == hira[-1]:
+                orig = orig[:-1]
+                hira = hira[:-1]
+            kanji_list.append(orig)
+            furigana_list.append(hira)
+
+    return [kanji_list, furigana_list]
+
+# Small kana and the long vowel mark are read with the syllable before them, the small tsu with the one after it
+small_kana = set("ぁぃぅぇぉゃゅょゎゕゖー")
+
+# Split the reading of a kana morpheme spanning several words at the word boundaries, as (number of words, romaji)
+# groups. A word left without a syllable once the small kana are moved is grouped with its neighbour, and the whole
+# morpheme is one group when the romaji of the parts doesn't add up to the romaji of the morpheme.
+def split_reading(morpheme, lengths):
+    unsplit = [(len(lengths), morpheme.hepburn)]
+    if len(morpheme.hira) != sum(lengths):
+        return unsplit
+
+    groups = []
+    offset = 0
+    for length in lengths:
+        piece = morpheme.hira[offset:offset + length]
+        offset += length
+        if groups:
+            previous = groups[-1]
+            moved = 0
+            while moved < len(piece) and piece[moved] in small_kana:
+                moved += 1
+            previous[1] += piece[:moved]
+            piece = piece[moved:]
+            while previous[1].endswith("っ"):
+                previous[1] = previous[1][:-1]
+                piece = "っ" + piece
+            if not piece or not previous[1]:
+                previous[0] += 1
+                previous[1] += piece
+                continue
+        groups.append([1, piece])
+
+    parts = [(count, romaji(piece)) for count, piece in groups]
+    if "".join(part for _, part in parts) != morpheme.hepburn:
+        return unsplit
+    return parts
+
+# Romaji words timed like the transcribed words, converting the line once and walking its morphemes in one pass.
+# A kanji compound read across several words (its reading can't be split) merges them into one word.
+def align_romaji(words):
+    owners = [i for i, word in enumerate(words) for _ in word["text"]]
+    if not owners:
+        return []
+    offsets = [0]
+    for word in words:
+        offsets.append(offsets[-1] + len(word["text"]))
+
+    aligned = []
+    aligned_words = {}
+    def entry(i):
+        if i not in aligned_words:
+            aligned.append({
+                "start": words[i]["start"],
+                "end": words[i]["end"],
+                "text": "",
+                "confidence": words[i]["confidence"],
+            })
+            aligned_words[i] = aligned[-1]
+        return aligned_words[i]
+
+    # One romaji word for several transcribed words, timed from the first one to the last one
+    def merge(indices, text):
+        merged = entry(indices[0])
+        merged["text"] += text
+        merged["end"] = words[indices[-1]]["end"]
+        for i in indices[1:]:
+            aligned_words[i] = merged
+
+    position = 0
+    for morpheme in readings("".join(word["text"] for word in words)):
+        morpheme_start = position
+        position += len(morpheme.orig)
+        first = owners[min(morpheme_start, len(owners) - 1)]
+        last = owners[min(position, len(owners)) - 1]
+
+        if first == last:
+            entry(first)["text"] += morpheme.hepburn
+        elif contains_kanji(morpheme.orig):
+            merge(list(range(first, last + 1)), morpheme.hepburn)
+        else:
+            spanned = [i for i in range(first, last + 1) if words[i]["text"]]
+            lengths = [min(offsets[i + 1], position) - max(offsets[i], morpheme_start) for i in spanned]
+            for count, part in split_reading(morpheme, lengths):
+                merge(spanned[:count], part)
+                spanned = spanned[count:]
+
+    return aligned
@@ -0,0 +1,217 @@
+import importlib
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from flask import jsonify, Blueprint
+from flask_cors import CORS
+
+from api import config
+from api.metrics import span, metrics_registry
+from api.progress import InvalidRequest, JobCancelled
+
+jobs = Blueprint("jobs", __name__)
+CORS(jobs)  # Enable CORS for cross-origin requests from the Next.js front end
+
+# For each stage: the module, the function reading the request form into parameters and the function doing the work
+stages = {
+    'separate': ('api.separate', 'separation_params', 'run_separation'),
+    'transcribe': ('api.transcribe', 'transcription_params', 'run_transcription'),
+    'render': ('api.render', 'render_params', 'run_render'),
+    'pipeline': ('api.pipeline', 'pipeline_params', 'run_pipeline'),
+    'batch': ('api.batch', 'batch_params', 'run_batch')
+}
+
+def stage_function(stage, index):
+    module_name = stages[stage][0]
+    return getattr(importlib.import_module(module_name), stages[stage][index])
+
+# Executed in the worker, progress and cancellation go through dicts shared with the server process
+def run_stage(job_id, stage, params, progress_state, cancelled):
+    def progress(step, percent=None):
+        if cancelled.get(job_id):
+            raise JobCancelled()
+        progress_state[job_id] = {'step': step, 'progress': percent, 'started_at': started_at}
+
+    started_at = time.time()
+    progress('starting', 0)
+    with span(stage) as trace:
+        result = stage_function(stage, 2)(params, progress)
+    # Time and memory of each step of the job, also aggregated on /api/metrics
+    if isinstance(result, dict):
+        result['trace'] = trace.to_dict()
+    return result
+
+# Task run once by each job worker process when the server starts
+def warm_up():
+    pass
+
+class JobManager:
+    def __init__(self, workers, executor_type, retention):
+        self.workers = workers
+        self.executor_type = executor_type
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.executor = None
+
+    def start(self):
+        if self.executor is not None:
+            return
+        if self.executor_type == "process":
+            # Workers are spawned so they can use CUDA, and keep their own warm models between jobs. The models are
+            # only imported here so the server process doesn't load them.
+            from api.models import preload_models
+            context = multiprocessing.get_context("spawn")
+            self.shared = context.Manager()
+            self.progress_state = self.shared.dict()
+            self.cancelled = self.shared.dict()
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=preload_models)
+            # The pool only starts its processes for tasks, one empty task per worker starts them all and their
+            # preloading right away instead of on the first jobs
+            for _ in range(self.workers):
+                self.executor.submit(warm_up)
+        else:
+            self.progress_state = {}
+            self.cancelled = {}
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def submit(self, stage, params):
+        if stage not in stages:
+            raise InvalidRequest(f"Unknown stage {stage}")
+
+        with self.lock:
+            self.start()
+            self.prune()
+            job_id = uuid.uuid4().hex
+            job = {
+                'job_id': job_id,
+                'stage': stage,
+                'state': 'queued',
+                'submitted_at': time.time(),
+                'finished_at': None,
+                'result': None,
+                'error': None,
+                'done': threading.Event()
+            }
+            self.jobs[job_id] = job
+            job['future'] = self.executor.submit(run_stage, job_id, stage, params, self.progress_state, self.cancelled)
+
+        job['future'].add_done_callback(lambda future: self.finish(job_id, future))
+        return job_id
+
+    def finish(self, job_id, future):
+        job = self.jobs[job_id]
+        if future.cancelled():
+            job['state'] = 'cancelled'
+        else:
+            error = future.exception()
+            if error is None:
+                job['state'] = 'done'
+                job['result'] = future.result()
+            elif isinstance(error, JobCancelled):
+                job['state'] = 'cancelled'
+            else:
+                job['state'] = 'failed'
+                job['error'] = str(error)
+        job['finished_at'] = time.time()
+        metrics_registry.count_job(job['stage'], job['state'])
+        if job['state'] == 'done' and isinstance(job['result'], dict) and 'trace' in job['result']:
+            metrics_registry.observe_trace(job['stage'], job['result']['trace'])
+        job['done'].set()
+
+    def prune(self):
+        # Forget finished jobs after the retention delay
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job['finished_at'] is not None and now - job['finished_at'] > self.retention:
+                del self.jobs[job_id]
+                self.progress_state.pop(job_id, None)
+                self.cancelled.pop(job_id, None)
+
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    def progress(self, job_id):
+        job = self.get(job_id)
+        progress = self.progress_state.get(job_id) or {}
+        state = job['state']
+        if state == 'queued' and progress:
+            state = 'running'
+        return {
+            'job_id': job_id,
+            'stage': job['stage'],
+            'state': state,
+            'step': 'done' if state == 'done' else progress.get('step'),
+            'progress': 100 if state == 'done' else progress.get('progress'),
+            'submitted_at': job['submitted_at'],
+            'started_at': progress.get('started_at'),
+            'finished_at': job['finished_at']
+        }
+
+    def status(self, job_id):
+        job = self.get(job_id)
+        return {**self.progress(job_id), 'result': job['result'], 'error': job['error']}
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        # Queued jobs are dropped right away, running ones stop at their next progress report
+        if not job['future'].cancel() and job['finished_at'] is None:
+            self.cancelled[job_id] = True
+        return self.progress(job_id)
+
+    def wait(self, job_id, timeout=None):
+        self.get(job_id)['done'].wait(timeout)
+        return self.status(job_id)
+
+job_manager = JobManager(config.JOB_WORKERS, config.JOB_EXECUTOR, config.JOB_RETENTION)
+
+# Synchronous endpoints submit their work as a job and answer with its result once done
+def run_job_and_respond(stage):
+    try:
+        params = stage_function(stage, 1)()
+    except InvalidRequest as e:
+        return jsonify({'error': str(e)}), 400
+
+    status = job_manager.wait(job_manager.submit(stage, params))
+    if status['state'] != 'done':
+        return jsonify({'error': status['error'] or f"Job {status['state']}"}), 500
+    return jsonify(status['result']), 200
+
+@jobs.route('/api/jobs/<stage>', methods=['POST'])
+def submit_job(stage):
+    try:
+        if stage not in stages:
+            raise InvalidRequest(f"Unknown stage {stage}")
+        params = stage_function(stage, 1)()
+        job_id = job_manager.submit(stage, params)
+    except InvalidRequest as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(job_manager.progress(job_id)), 202
+
+@jobs.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    try:
+        return jsonify(job_manager.status(job_id)), 200
+    except KeyError:
+        return jsonify({'error': 'Job not found'}), 404
+
+@jobs.route('/api/jobs/<job_id>/progress', methods=['GET'])
+def job_progress(job_id):
+    try:
+        return jsonify(job_manager.progress(job_id)), 200
+    except KeyError:
+        return jsonify({'error': 'Job not found'}), 404
+
+@jobs.route('/api/jobs/<job_id>', methods=['DELETE'])
+@jobs.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    try:
+        return jsonify(job_manager.cancel(job_id)), 200
+    except KeyError:
+        return jsonify({'error': 'Job not found'}), 404
@@ -0,0 +1,197 @@
+import contextvars
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, Blueprint
+from flask_cors import CORS
+
+metrics = Blueprint("metrics", __name__)
+CORS(metrics)
+
+try:
+    page_size = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    page_size = None
+
+# Resident memory of the process, read from /proc where available since it's much cheaper than psutil
+def rss_mb():
+    if page_size is not None:
+        try:
+            with open('/proc/self/statm', 'rb') as f:
+                return int(f.read().split()[1]) * page_size / (1024.0 * 1024.0)
+        except OSError:
+            pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+# Highest resident memory of the process since the last reset_high_water_mark (VmHWM), or since it started where /proc
+# isn't available (ru_maxrss)
+def high_water_mark_mb():
+    try:
+        with open('/proc/self/status', 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+high_water_mark_resettable = False
+
+# Bring the high-water mark down to the current resident memory (Linux only)
+def reset_high_water_mark():
+    global high_water_mark_resettable
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        high_water_mark_resettable = True
+    except OSError:
+        high_water_mark_resettable = False
+
+# Steps running in any thread, the high-water mark is the one of the whole process
+open_spans = set()
+open_spans_lock = threading.Lock()
+
+# A timed step of a request, with the steps it is made of
+class Span:
+    __slots__ = ('name', 'start', 'duration', 'peak_rss_mb', 'start_high_water_mb', 'children', 'attributes')
+
+    def __init__(self, name, attributes=None):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.peak_rss_mb = rss_mb()
+        self.start_high_water_mb = None
+        self.children = []
+        self.attributes = attributes or {}
+
+    # The mark is reset at the start of every step, the running steps keep the peak reached until then
+    def begin(self):
+        with open_spans_lock:
+            high_water = high_water_mark_mb()
+            for step in open_spans:
+                step.peak_rss_mb = max(step.peak_rss_mb, high_water)
+            reset_high_water_mark()
+            self.start_high_water_mb = high_water_mark_mb()
+            open_spans.add(self)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        with open_spans_lock:
+            open_spans.discard(self)
+            high_water = high_water_mark_mb()
+        # A mark that can't be reset (ru_maxrss) only tells about this step when it went up during it, otherwise the
+        # memory at its start and end is all that is known
+        if high_water_mark_resettable or (self.start_high_water_mb is not None and high_water > self.start_high_water_mb):
+            peak = high_water
+        else:
+            peak = rss_mb()
+        self.peak_rss_mb = max([self.peak_rss_mb, peak] + [child.peak_rss_mb for child in self.children])
+
+    def to_dict(self):
+        result = {'name': self.name, 'duration': self.duration, 'peak_rss_mb': self.peak_rss_mb}
+        if self.attributes:
+            result['attributes'] = self.attributes
+        if self.children:
+            result['children'] = [child.to_dict() for child in self.children]
+        return result
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+# Time a step, nested in the step running in the same thread if any
+@contextmanager
+def span(name, **attributes):
+    parent = current_span.get()
+    step = Span(name, attributes)
+    step.begin()
+    token = current_span.set(step)
+    try:
+        yield step
+    finally:
+        step.finish()
+        current_span.reset(token)
+        if parent is not None:
+            parent.children.append(step)
+
+# Add a step timed by the caller, for work interleaved with other work like drawing and encoding frames
+def record_span(name, duration, **attributes):
+    parent = current_span.get()
+    if parent is None:
+        return
+    step = Span(name, attributes)
+    step.duration = duration
+    parent.children.append(step)
+
+# Aggregated over the finished jobs, in the server process since the jobs can run in worker processes
+class MetricsRegistry:
+    buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.peak_rss = {}
+        self.jobs = {}
+
+    def count_job(self, stage, state):
+        with self.lock:
+            self.jobs[(stage, state)] = self.jobs.get((stage, state), 0) + 1
+
+    def observe(self, stage, name, duration, peak_rss_mb):
+        key = (stage, name)
+        with self.lock:
+            counts, total, count = self.histograms.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [bucket_count + (duration <= bound) for bucket_count, bound in zip(counts, self.buckets)]
+            self.histograms[key] = (counts, total + duration, count + 1)
+            self.peak_rss[key] = max(self.peak_rss.get(key, 0.0), peak_rss_mb)
+
+    def observe_trace(self, stage, trace):
+        pending = [trace]
+        while pending:
+            step = pending.pop()
+            if step.get('duration') is not None:
+                self.observe(stage, step['name'], step['duration'], step.get('peak_rss_mb', 0.0))
+            pending.extend(step.get('children', []))
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = [
+            '# HELP karaok_jobs_total Finished jobs by stage and final state.',
+            '# TYPE karaok_jobs_total counter'
+        ]
+        with self.lock:
+            for (stage, state), count in sorted(self.jobs.items()):
+                lines.append(f'karaok_jobs_total{{stage="{stage}",state="{state}"}} {count}')
+
+            lines += [
+                '# HELP karaok_span_duration_seconds Duration of the steps of the finished jobs.',
+                '# TYPE karaok_span_duration_seconds histogram'
+            ]
+            for (stage, name), (counts, total, count) in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",span="{escape(name)}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'karaok_span_duration_seconds_bucket{{{labels},le="{bound}"}} {bucket_count}')
+                lines.append(f'karaok_span_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'karaok_span_duration_seconds_sum{{{labels}}} {total}')
+                lines.append(f'karaok_span_duration_seconds_count{{{labels}}} {count}')
+
+            lines += [
+                '# HELP karaok_span_peak_rss_megabytes Highest resident memory seen during each step.',
+                '# TYPE karaok_span_peak_rss_megabytes gauge'
+            ]
+            for (stage, name), peak in sorted(self.peak_rss.items()):
+                lines.append(f'karaok_span_peak_rss_megabytes{{stage="{stage}",span="{escape(name)}"}} {peak}')
+        return "\n".join(lines) + "\n"
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics_registry = MetricsRegistry()
+
+@metrics.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
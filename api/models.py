@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+import whisper_timestamped as whisper
+from audio_separator.separator import Separator
+
+from api import config
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def model_size_bytes(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+# Process-wide registry keeping Whisper models loaded across requests, evicted in LRU order past the memory budget
+class WhisperModelRegistry:
+    def __init__(self, memory_budget_bytes):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, size, device=None):
+        key = (size, device or default_device())
+
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0], 0.0
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given model, the others wait for it and reuse it
+        with key_lock:
+            with self.lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    return self.models[key][0], 0.0
+
+            load_start = time.time()
+            model = whisper.load_model(key[0], device=key[1])
+            load_time = time.time() - load_start
+
+            with self.lock:
+                self.models[key] = (model, model_size_bytes(model))
+                self.evict(keep=key)
+
+        return model, load_time
+
+    # Whisper installs hooks on the model while decoding, so a model is only used by one thread at a time
+    @contextmanager
+    def use(self, size, device=None):
+        model, load_time = self.get(size, device)
+        with self.lock:
+            model_lock = self.key_locks.setdefault(("use", id(model)), threading.Lock())
+        with model_lock:
+            yield model, load_time
+
+    def evict(self, keep=None):
+        total = sum(nbytes for _, nbytes in self.models.values())
+        for key in list(self.models.keys()):
+            if total <= self.memory_budget_bytes:
+                break
+            if key == keep:
+                continue
+            model, nbytes = self.models.pop(key)
+            self.key_locks.pop(("use", id(model)), None)
+            total -= nbytes
+            if key[1] == "cuda":
+                torch.cuda.empty_cache()
+
+    def loaded(self):
+        with self.lock:
+            return [{"model": size, "device": device, "bytes": nbytes} for (size, device), (_, nbytes) in self.models.items()]
+
+whisper_models = WhisperModelRegistry(config.WHISPER_MEMORY_BUDGET_MB * 1024 * 1024)
+
+# Pool of loaded audio separators keyed by model filename, each separator is used by one request at a time
+class SeparatorPool:
+    def __init__(self, output_dir, max_size, max_per_model, idle_timeout):
+        self.output_dir = output_dir
+        self.max_size = max_size
+        self.max_per_model = max_per_model
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        self.idle = {}
+        self.instances = {}
+        self.janitor = None
+
+    def total(self):
+        return sum(self.instances.values())
+
+    def evict_idle(self, older_than=None):
+        # Drop separators unused for longer than the idle timeout, or the least recently used one if older_than is None
+        now = time.time()
+        idle = [(last_used, model_filename, separator) for model_filename, separators in self.idle.items() for separator, last_used in separators]
+        idle.sort(key=lambda item: item[0])
+        if older_than is None:
+            idle = idle[:1]
+        else:
+            idle = [item for item in idle if now - item[0] > older_than]
+        for last_used, model_filename, separator in idle:
+            self.idle[model_filename] = [(s, t) for s, t in self.idle[model_filename] if s is not separator]
+            self.instances[model_filename] -= 1
+        return len(idle) > 0
+
+    def start_janitor(self):
+        def run():
+            while True:
+                time.sleep(max(self.idle_timeout / 2, 1))
+                with self.condition:
+                    if self.evict_idle(self.idle_timeout):
+                        self.condition.notify_all()
+
+        if self.janitor is None:
+            self.janitor = threading.Thread(target=run, daemon=True)
+            self.janitor.start()
+
+    @contextmanager
+    def acquire(self, model_filename):
+        wait_start = time.time()
+        separator = None
+        with self.condition:
+            self.start_janitor()
+            while True:
+                if self.idle.get(model_filename):
+                    separator, _ = self.idle[model_filename].pop()
+                    break
+                if self.instances.get(model_filename, 0) < self.max_per_model:
+                    # Make room by unloading an idle separator of another model
+                    if self.total() >= self.max_size:
+                        self.evict_idle()
+                    if self.total() < self.max_size:
+                        self.instances[model_filename] = self.instances.get(model_filename, 0) + 1
+                        break
+                self.condition.wait()
+        queue_wait_time = time.time() - wait_start
+
+        model_load_time = 0.0
+        if separator is None:
+            try:
+                load_start = time.time()
+                separator = Separator(
+                    output_dir=self.output_dir,
+                    output_format="wav"
+                )
+                separator.load_model(model_filename=model_filename)
+                model_load_time = time.time() - load_start
+            except Exception:
+                with self.condition:
+                    self.instances[model_filename] -= 1
+                    self.condition.notify_all()
+                raise
+
+        try:
+            yield separator, {'queue_wait_time': queue_wait_time, 'model_load_time': model_load_time}
+        finally:
+            with self.condition:
+                self.idle.setdefault(model_filename, []).append((separator, time.time()))
+                self.condition.notify_all()
+
+separator_pool = SeparatorPool(os.path.join('output/', 'tmp/'), config.SEPARATOR_POOL_SIZE, config.SEPARATOR_POOL_PER_MODEL, config.SEPARATOR_IDLE_TIMEOUT)
+
+# Load the configured models in the background so the server starts answering right away
+def preload_models():
+    def preload():
+        for size in config.WHISPER_PRELOAD:
+            try:
+                whisper_models.get(size)
+            except Exception as e:
+                print(f"Error preloading Whisper model {size}: {e}")
+
+    if config.WHISPER_PRELOAD:
+        threading.Thread(target=preload, daemon=True).start()
+
+# Time the initializer of this chunk transcription process took to load its model
+transcription_worker_load_time = 0.0
+
+# Initializer of the chunk transcription processes: the cores are shared between the workers, and the model is loaded
+# once per process before the first chunk
+def init_transcription_worker(model_size, threads):
+    global transcription_worker_load_time
+    torch.set_num_threads(threads)
+    _, transcription_worker_load_time = whisper_models.get(model_size, "cpu")
+
+# Sent back with the first result of a chunk transcription process, 0 afterwards
+def take_transcription_worker_load_time():
+    global transcription_worker_load_time
+    load_time, transcription_worker_load_time = transcription_worker_load_time, 0.0
+    return load_time
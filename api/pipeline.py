@@ -0,0 +1,178 @@
+import os
+import time
+import json
+from flask import request, Blueprint
+from flask_cors import CORS
+
+import numpy as np
+import soundfile as sf
+import librosa
+
+from api import config
+from api.audio import write_audio_metadata
+from api.progress import no_progress
+from api.jobs import run_job_and_respond
+from api.separate import separate_file, separation_params, tmp_folder
+from api.youtube import download_youtube_audio
+from api.transcribe import transcribe_voiced, transcription_key
+from api.stage_cache import stage_cache, fingerprint_samples
+from api.render import build_layout, render_layout, render_profile, video_filename, output_folder, public_folder
+from api.text_cache import text_cache
+from api.metrics import span
+from api.stream import streaming
+
+pipeline = Blueprint('pipeline', __name__)
+CORS(pipeline)  # Enable CORS for cross-origin requests from the Next.js front end
+
+whisper_samplerate = 16000
+
+def read_stem(filepath):
+    return sf.read(filepath, dtype='float32', always_2d=True)
+
+# Same input as whisper.load_audio (16 kHz mono float32), resampled in memory instead of spawning ffmpeg
+def to_whisper_audio(samples, samplerate):
+    mono = samples.mean(axis=1)
+    return librosa.resample(mono, orig_sr=samplerate, target_sr=whisper_samplerate).astype(np.float32)
+
+# The song is handed from stage to stage as a dict holding its stems and transcription in memory, and its result so far
+
+# audio-separator can only write its stems to disk, they're read once and removed unless asked to keep them
+def separate_song(filename, model_filename, keep_intermediates=False, base_filename=None, progress=no_progress):
+    with span('separate'):
+        separation = separate_file(filename, model_filename, progress, base_filename)
+        base_filename = separation['base_filename']
+        vocals_filepath = os.path.join(tmp_folder, separation['vocals_filename'])
+        inst_filepath = os.path.join(tmp_folder, separation['inst_filename'])
+        with span('read stems'):
+            vocals, vocals_samplerate = read_stem(vocals_filepath)
+            inst, inst_samplerate = read_stem(inst_filepath)
+    audio_duration = len(inst) / float(inst_samplerate)
+    if keep_intermediates:
+        write_audio_metadata(vocals_filepath)
+        write_audio_metadata(inst_filepath)
+    else:
+        os.remove(vocals_filepath)
+        os.remove(inst_filepath)
+
+    result = {
+        'base_filename': base_filename,
+        'audio_duration': audio_duration,
+        'separation_cache_hit': separation['cache_hit'],
+        'separation_time': separation['separation_time'],
+        'model_load_time': separation['model_load_time'],
+        'queue_wait_time': separation['queue_wait_time']
+    }
+    if keep_intermediates:
+        result.update({'vocals_filename': separation['vocals_filename'], 'inst_filename': separation['inst_filename']})
+    return {'vocals': (vocals, vocals_samplerate), 'inst': (inst, inst_samplerate), 'result': result}
+
+def transcribe_song(song, whisper_model=None, keep_intermediates=False, progress=no_progress):
+    transc_start = time.time()
+    whisper_model = whisper_model or config.WHISPER_MODEL
+    # The vocals aren't needed after this stage
+    vocals, vocals_samplerate = song.pop('vocals')
+    with span('transcribe'):
+        cache_key = transcription_key(fingerprint_samples(vocals, vocals_samplerate), whisper_model)
+        transcription_cache_hit = stage_cache.lookup(cache_key) is not None
+        if transcription_cache_hit:
+            transcription_result = json.loads(stage_cache.read(cache_key, 'transcription.json'))
+            model_load_time = inference_time = 0.0
+            vad = None
+        else:
+            with span('resample'):
+                whisper_audio = to_whisper_audio(vocals, vocals_samplerate)
+            transcription_result, model_load_time, inference_time, vad = transcribe_voiced(whisper_audio, whisper_model, progress)
+            stage_cache.store(cache_key, 'transcribe', contents={'transcription.json': json.dumps(transcription_result).encode("utf-8")})
+    del vocals
+    song['transcription'] = transcription_result
+
+    if keep_intermediates:
+        transcription_filename = f"{song['result']['base_filename']}.json"
+        with open(os.path.join(tmp_folder, transcription_filename), "w") as f:
+            json.dump(transcription_result, f)
+        song['result']['transcription'] = transcription_filename
+
+    song['result'].update({
+        'transcription_cache_hit': transcription_cache_hit,
+        'transc_time': time.time() - transc_start,
+        'whisper_load_time': model_load_time,
+        'inference_time': inference_time,
+        'vad': vad
+    })
+    return song
+
+def render_song(song, alphabet, translation, render_mode=None, profile=None, progress=no_progress, stream=False):
+    render_start = time.time()
+    render_mode = "compositor" if stream else render_mode or config.RENDER_MODE
+    settings = render_profile(profile)
+    result = song['result']
+    video_filepath = os.path.join(output_folder, video_filename(result['base_filename'], profile, render_mode=render_mode))
+    public_video_filepath = os.path.join(public_folder, video_filepath)
+
+    progress('preparing lyrics', 0)
+    with streaming(public_video_filepath, stream):
+        with span('build layout'):
+            layout = build_layout(song.pop('transcription'), result['audio_duration'], alphabet, translation, progress, video_size=settings['video_size'], fps=settings['fps'])
+        render_layout(layout, song.pop('inst'), public_video_filepath, render_mode, progress, preset=settings['preset'], stream=stream)
+
+    result.update({
+        'video': video_filepath,
+        'render_time': time.time() - render_start,
+        'render_mode': render_mode,
+        'profile': profile or config.RENDER_PROFILE
+    })
+    return song
+
+# Separate, transcribe and render a song in one process, handing the stems and the transcription over in memory
+def make_karaoke(filename, model_filename, alphabet, translation, whisper_model=None, render_mode=None, keep_intermediates=False, base_filename=None, progress=no_progress, profile=None, stream=False):
+    pipeline_start = time.time()
+    text_cache_start = text_cache.stats()
+
+    song = separate_song(filename, model_filename, keep_intermediates, base_filename, progress)
+    transcribe_song(song, whisper_model, keep_intermediates, progress)
+    render_song(song, alphabet, translation, render_mode, profile, progress, stream)
+
+    return {
+        **song['result'],
+        'text_cache': text_cache.stats(since=text_cache_start),
+        'total_time': time.time() - pipeline_start
+    }
+
+def pipeline_params():
+    params = separation_params()
+    render_profile(request.form.get('profile'))
+    params.update({
+        'alphabet': request.form.get('alphabet'),
+        'translation': request.form.get('translation'),
+        'whisper_model': request.form.get('whisper_model'),
+        'render_mode': request.form.get('render_mode'),
+        'profile': request.form.get('profile'),
+        'stream': request.form.get('stream', 'false').lower() in ('1', 'true', 'yes'),
+        'keep_intermediates': request.form.get('keep_intermediates', 'false').lower() in ('1', 'true', 'yes')
+    })
+    return params
+
+def run_pipeline(params, progress=no_progress):
+    filename = params.get('filename')
+    base_filename = None
+    if 'music_link' in params:
+        progress('downloading', 0)
+        with span('download'):
+            filename, base_filename = download_youtube_audio(params['music_link'])
+    return make_karaoke(
+        filename,
+        params['model_filename'],
+        params['alphabet'],
+        params['translation'],
+        whisper_model=params.get('whisper_model'),
+        render_mode=params.get('render_mode'),
+        keep_intermediates=params.get('keep_intermediates', False),
+        base_filename=base_filename,
+        progress=progress,
+        profile=params.get('profile'),
+        stream=params.get('stream', False)
+    )
+
+@pipeline.route('/api/pipeline', methods=['POST'])
+def pipeline_audio():
+    return run_job_and_respond('pipeline')
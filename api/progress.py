@@ -0,0 +1,14 @@
+# Shared by the stages and the job manager, kept free of other imports so the stages and the server can use it
+# without loading the separation and transcription models
+
+# Raised by the request parsers when the form is missing or has invalid fields
+class InvalidRequest(ValueError):
+    pass
+
+# Raised from the progress callback when the job was cancelled, which stops the stage at its next progress report
+class JobCancelled(Exception):
+    pass
+
+# Progress callback used when a stage runs outside of a job
+def no_progress(step, percent=None):
+    pass
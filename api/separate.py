@@ -1,13 +1,19 @@
 import os
 import time
-import re
-from flask import request, jsonify, Blueprint
-from flask_cors import CORS
 
-import librosa
-from audio_separator.separator import Separator
+import numpy as np
+import soundfile as sf
+from flask import request, Blueprint
+from flask_cors import CORS
 
-import yt_dlp
+from api.models import separator_pool
+from api.youtube import is_youtube_link, download_youtube_audio
+from api import config
+from api.audio import write_audio_metadata, probe_header, stream_audio
+from api.stage_cache import stage_cache, stage_key, audio_fingerprint
+from api.metrics import span, record_span
+from api.progress import InvalidRequest, no_progress
+from api.jobs import run_job_and_respond
 
 separate = Blueprint('separate', __name__)
 CORS(separate)
@@ -19,112 +25,180 @@ allowed_extensions = {'mp3', 'wav'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
-def is_youtube_link(link):
-    youtube_regex = (
-        r'(https?://)?(www\.)?'
-        '(youtube\.com/watch\?v=|youtu\.be/)'
-        '[^\s]{11}'
-    )
-    return re.match(youtube_regex, link) is not None
-
-def get_youtube_video_title(url):
-    
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'forcetitle': True,
-        'skip_download': True,  # Ne télécharge pas la vidéo
+separation_samplerate = 44100
+
+def read_separated(filepath, frames):
+    samples, samplerate = sf.read(filepath, dtype='float32', always_2d=True)
+    os.remove(filepath)
+    # The models can add or drop a few samples, the windows have to line up
+    if len(samples) < frames:
+        samples = np.concatenate([samples, np.zeros((frames - len(samples), samples.shape[1]), dtype=np.float32)])
+    return samples[:frames], samplerate
+
+# Separate long files window by window, the windows overlap and are crossfaded, and the stems are written as they come.
+# Returns False without separating anything when the file fits in one window.
+def separate_in_chunks(separator, filename, base_filename, base_model_filename, stem_filepaths, progress=no_progress):
+    hop = int(config.SEPARATION_CHUNK_SECONDS * separation_samplerate)
+    overlap = min(int(config.SEPARATION_OVERLAP_SECONDS * separation_samplerate), hop)
+    if hop <= 0:
+        return False
+
+    # Most songs fit in one window, the header tells so without starting a decode. Without a header that can be trusted
+    # (e.g. MP3), the stream finds it out after two windows at most.
+    header = probe_header(filename)
+    nb_chunks = int(np.ceil(header['duration'] * separation_samplerate / hop)) if header else None
+    if nb_chunks is not None and nb_chunks <= 1:
+        return False
+
+    blocks = stream_audio(filename, separation_samplerate, 2, hop)
+    current = next(blocks, None)
+    following = next(blocks, None)
+    if current is None or following is None:
+        blocks.close()
+        return False
+
+    chunk_filepath = os.path.join(tmp_folder, f"{base_filename}_chunk.wav")
+    stems = {name: {'writer': None, 'tail': None} for name in stem_filepaths}
+    try:
+        chunk = 0
+        while current is not None:
+            progress('separating', 100 * chunk / nb_chunks if nb_chunks else None)
+            window = current if following is None else np.concatenate([current, following[:overlap]])
+            sf.write(chunk_filepath, window, separation_samplerate, subtype='FLOAT')
+            separator.separate(chunk_filepath)
+
+            for name, stem in stems.items():
+                samples, samplerate = read_separated(os.path.join(tmp_folder, f"{base_filename}_chunk_({name})_{base_model_filename}.wav"), len(window))
+                if stem['writer'] is None:
+                    stem['writer'] = sf.SoundFile(stem_filepaths[name], 'w', samplerate=samplerate, channels=samples.shape[1], subtype='PCM_16')
+
+                # Fade from the end of the previous window to the start of this one over the part they share
+                start = 0
+                if stem['tail'] is not None:
+                    start = len(stem['tail'])
+                    fade = np.linspace(0.0, 1.0, start, dtype=np.float32)[:, np.newaxis]
+                    stem['writer'].write(stem['tail'] * (1.0 - fade) + samples[:start] * fade)
+                end = len(current)
+                stem['writer'].write(samples[start:end])
+                stem['tail'] = samples[end:] if end < len(window) else None
+
+            chunk += 1
+            current, following = following, next(blocks, None)
+    finally:
+        blocks.close()
+        for stem in stems.values():
+            if stem['writer'] is not None:
+                stem['writer'].close()
+        if os.path.exists(chunk_filepath):
+            os.remove(chunk_filepath)
+
+    progress('separating', 100)
+    return True
+
+# Separate an uploaded file into its vocals and instrumental stems, written to the tmp folder
+def separate_file(filename, model_filename, progress=no_progress, base_filename=None):
+    base_filename = base_filename or os.path.splitext(filename)[0]
+    filename = os.path.join(upload_folder, filename)
+
+    # Define the output file name based on the chosen model and output format
+    base_model_filename = os.path.splitext(model_filename)[0]
+    vocals_filename = f"{base_filename}_(Vocals)_{base_model_filename}.wav"
+    vocals_filepath = os.path.join(tmp_folder, vocals_filename)
+    inst_filename = f"{base_filename}_(Instrumental)_{base_model_filename}.wav"
+    inst_filepath = os.path.join(tmp_folder, inst_filename)
+
+    # Reuse the stems if this audio was already separated with the same model
+    progress('looking up cache', 0)
+    cache_start = time.time()
+    options = {'model_filename': model_filename}
+    if config.SEPARATION_CHUNK_SECONDS > 0:
+        options['chunks'] = [config.SEPARATION_CHUNK_SECONDS, config.SEPARATION_OVERLAP_SECONDS]
+    with span('cache lookup'):
+        cache_key = stage_key('separate', audio_fingerprint(filename), options)
+        cache_hit = stage_cache.lookup(cache_key) is not None
+        if cache_hit:
+            stage_cache.restore(cache_key, 'vocals.wav', vocals_filepath)
+            stage_cache.restore(cache_key, 'instrumental.wav', inst_filepath)
+    if cache_hit:
+        return {
+            'base_filename': base_filename,
+            'vocals_filename': vocals_filename,
+            'inst_filename': inst_filename,
+            'separation_time': 0.0,
+            'model_load_time': 0.0,
+            'queue_wait_time': 0.0,
+            'cache_hit': True,
+            'cache_time': time.time() - cache_start
+        }
+
+    progress('waiting for separator', 0)
+    with separator_pool.acquire(model_filename) as (separator, pool_times):
+        record_span('wait for separator', pool_times['queue_wait_time'])
+        record_span('load separator model', pool_times['model_load_time'])
+        progress('separating', 0)
+        separation_start = time.time()
+        with span('separation', model=model_filename):
+            stem_filepaths = {'Vocals': vocals_filepath, 'Instrumental': inst_filepath}
+            if not separate_in_chunks(separator, filename, base_filename, base_model_filename, stem_filepaths, progress):
+                separator.separate(filename)
+        separation_time = time.time() - separation_start
+
+    # Check if the separated file exists
+    if not os.path.exists(inst_filepath):
+        raise RuntimeError('Audio separation failed, file not found')
+
+    with span('cache store'):
+        stage_cache.store(cache_key, 'separate', files={'vocals.wav': vocals_filepath, 'instrumental.wav': inst_filepath})
+
+    return {
+        'base_filename': base_filename,
+        'vocals_filename': vocals_filename,
+        'inst_filename': inst_filename,
+        'separation_time': separation_time,
+        'model_load_time': pool_times['model_load_time'],
+        'queue_wait_time': pool_times['queue_wait_time'],
+        'cache_hit': False
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(url, download=False)
-        video_title = info_dict.get('title', None)
+def separate_audio(filename, model_filename, progress=no_progress, base_filename=None):
+    result = separate_file(filename, model_filename, progress, base_filename)
+    vocals_filepath = os.path.join(tmp_folder, result['vocals_filename'])
+    inst_filepath = os.path.join(tmp_folder, result['inst_filename'])
 
-    return video_title
+    # Write metadata sidecars so the next stages get the duration without decoding the stems
+    progress('probing stems', 100)
+    with span('probe stems'):
+        if os.path.exists(vocals_filepath):
+            write_audio_metadata(vocals_filepath)
+        audio_duration = write_audio_metadata(inst_filepath)['duration']
 
-def separate_audio(filename):
-    base_filename = os.path.splitext(filename)[0]
-    filename = os.path.join(upload_folder, filename)
+    return {**result, 'audio_duration': audio_duration}
 
+# Read the request into the parameters of a separation job, saving the uploaded file if there is one
+def separation_params():
     model_filename = request.form.get('model_filename')
-
-    try:
-        audio_start = time.time()
-        separator = Separator(
-            output_dir=tmp_folder,
-            output_format="wav"
-        )
-        separator.load_model(model_filename=model_filename)
-        separator.separate(filename)
-
-        # Define the output file name based on the chosen model and output format
-        base_model_filename = os.path.splitext(model_filename)[0]
-        vocals_filename = f"{base_filename}_(Vocals)_{base_model_filename}.wav"
-        vocals_filepath = os.path.join(tmp_folder, vocals_filename)
-        inst_filename = f"{base_filename}_(Instrumental)_{base_model_filename}.wav"
-        inst_filepath = os.path.join(tmp_folder, inst_filename)
-
-        # Check if the separated file exists
-        if not os.path.exists(inst_filepath):
-            return jsonify({'error': 'Audio separation failed, file not found'}), 500
-        
-        audio_end = time.time()
-        audio_time = audio_end - audio_start
-
-        y, sr = librosa.load(inst_filepath)
-        audio_duration = librosa.get_duration(y=y, sr=sr)
-
-        return jsonify({
-            'base_filename': base_filename,
-            'vocals_filename': vocals_filename,
-            'inst_filename': inst_filename,
-            'separation_time': audio_time,
-            'audio_duration': audio_duration
-        }), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-    
-@separate.route('/api/separate', methods=['POST'])
-def upload_file():
-    error = False
     if 'file' in request.files:
         file = request.files['file']
-        if not(file.filename == ''):
-            if file and allowed_file(file.filename):
-                filepathname = os.path.join(upload_folder, file.filename)
-                file.save(filepathname)
-
-                return separate_audio(file.filename)
-            else:
-                error = True
-        else:
-            error = True
+        if file.filename != '' and allowed_file(file.filename):
+            filepathname = os.path.join(upload_folder, file.filename)
+            file.save(filepathname)
+            return {'filename': file.filename, 'model_filename': model_filename}
     elif 'musicLink' in request.form:
-        musicLink = request.form.get('musicLink')
-        if is_youtube_link(musicLink):
-
-            filename = get_youtube_video_title(musicLink)
-            filename = filename.replace("/", "_").replace("\\", "_").replace(":", "_").replace("*", "_").replace("?", "_").replace("\"", "_").replace("<", "_").replace(">", "_").replace("|", "_").replace("#", "_")
-            filepathname = upload_folder + filename
-            filename = filename + ".mp3"
-
-            ydl_opts = {
-                'format': 'mp3/bestaudio/best',
-                'postprocessors': [{  # Extract audio using ffmpeg
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                }],
-                'outtmpl': filepathname,
-            }
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                error_code = ydl.download(musicLink)
-
-            return separate_audio(filename)
-        else:
-            error = True
-    else:
-        error = True
-
-    if error:
-        return jsonify({'error': 'Error in music link or file in the request'}), 400
\ No newline at end of file
+        music_link = request.form.get('musicLink')
+        if is_youtube_link(music_link):
+            return {'music_link': music_link, 'model_filename': model_filename}
+
+    raise InvalidRequest('Error in music link or file in the request')
+
+def run_separation(params, progress=no_progress):
+    filename = params.get('filename')
+    base_filename = None
+    if 'music_link' in params:
+        progress('downloading', 0)
+        with span('download'):
+            filename, base_filename = download_youtube_audio(params['music_link'])
+    return separate_audio(filename, params['model_filename'], progress, base_filename)
+
+@separate.route('/api/separate', methods=['POST'])
+def upload_file():
+    return run_job_and_respond('separate')
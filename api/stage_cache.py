@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import soundfile as sf
+
+from api import config
+from api.audio import metadata_path, read_audio_metadata, stream_audio
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Hash of the decoded samples, so the same song uploaded under another name or title gets the same key
+def fingerprint_samples(samples, samplerate):
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    digest = hashlib.sha256(f"{samplerate}:{samples.shape[1]}:".encode("utf-8"))
+    digest.update(memoryview(samples).cast('B'))
+    return digest.hexdigest()
+
+# Formats libsndfile can't read (e.g. the webm and m4a audio of YouTube videos) are hashed as they're decoded by ffmpeg,
+# at a fixed sample rate and channel count, so the memory used doesn't depend on the length of the song
+def stream_fingerprint(filepath, samplerate=44100, channels=2):
+    digest = hashlib.sha256(f"ffmpeg:{samplerate}:{channels}:".encode("utf-8"))
+    decoded = False
+    for block in stream_audio(filepath, samplerate, channels, 65536):
+        digest.update(memoryview(np.ascontiguousarray(block)).cast('B'))
+        decoded = True
+    if decoded:
+        return digest.hexdigest()
+
+    # Nothing ffmpeg could decode either, the file is still told apart from others by its bytes
+    digest = hashlib.sha256(b"file:")
+    with open(filepath, "rb") as f:
+        for data in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+def audio_fingerprint(filepath):
+    metadata = read_audio_metadata(filepath)
+    if metadata is not None and metadata.get('fingerprint'):
+        return metadata['fingerprint']
+
+    try:
+        info = sf.info(filepath)
+        digest = hashlib.sha256(f"{info.samplerate}:{info.channels}:".encode("utf-8"))
+        for block in sf.blocks(filepath, blocksize=65536, dtype='float32', always_2d=True):
+            digest.update(memoryview(np.ascontiguousarray(block)).cast('B'))
+        fingerprint = digest.hexdigest()
+    except Exception:
+        fingerprint = stream_fingerprint(filepath)
+
+    # Remember it in the metadata sidecar so the next stage doesn't decode the file again
+    if metadata is not None:
+        metadata.pop('source', None)
+        with open(metadata_path(filepath), "w") as f:
+            json.dump({**metadata, 'fingerprint': fingerprint}, f)
+    return fingerprint
+
+def stage_key(stage, fingerprint, options):
+    description = json.dumps({'stage': stage, 'fingerprint': fingerprint, 'options': options}, sort_keys=True)
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+# Artifacts of the separation and transcription stages keyed by their inputs, evicted in LRU order past the size limit
+class StageCache:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(folder, 'index.json')
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def locked_index(self):
+        # Job workers are separate processes, the index is shared through the file and an exclusive lock on it
+        os.makedirs(self.folder, exist_ok=True)
+        with self.lock, open(os.path.join(self.folder, 'index.lock'), 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = {}
+                if os.path.exists(self.index_path):
+                    try:
+                        with open(self.index_path, 'r') as f:
+                            index = json.load(f)
+                    except ValueError:
+                        index = {}
+                original = json.dumps(index, sort_keys=True)
+                yield index
+                if json.dumps(index, sort_keys=True) != original:
+                    tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'w') as f:
+                        json.dump(index, f)
+                    os.replace(tmp_path, self.index_path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def entry_folder(self, key):
+        return os.path.join(self.folder, key)
+
+    def lookup(self, key):
+        with self.locked_index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+            if not all(os.path.exists(os.path.join(self.entry_folder(key), name)) for name in entry['files']):
+                del index[key]
+                return None
+            entry['last_access'] = time.time()
+            return entry
+
+    def restore(self, key, name, destination):
+        shutil.copyfile(os.path.join(self.entry_folder(key), name), destination)
+
+    def read(self, key, name):
+        with open(os.path.join(self.entry_folder(key), name), 'rb') as f:
+            return f.read()
+
+    def store(self, key, stage, files=None, contents=None):
+        files = files or {}
+        contents = contents or {}
+        if self.max_bytes <= 0:
+            return
+
+        # Files are written to a temporary folder first so a partial entry is never visible
+        folder = self.entry_folder(key)
+        tmp_folder = f"{folder}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_folder, exist_ok=True)
+        for name, source in files.items():
+            shutil.copyfile(source, os.path.join(tmp_folder, name))
+        for name, data in contents.items():
+            with open(os.path.join(tmp_folder, name), 'wb') as f:
+                f.write(data)
+        size = sum(os.path.getsize(os.path.join(tmp_folder, name)) for name in os.listdir(tmp_folder))
+
+        with self.locked_index() as index:
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+            os.replace(tmp_folder, folder)
+            now = time.time()
+            index[key] = {'stage': stage, 'files': sorted(list(files) + list(contents)), 'size': size, 'created': now, 'last_access': now}
+            self.evict(index, keep=key)
+
+    def evict(self, index, keep=None):
+        total = sum(entry['size'] for entry in index.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]['last_access']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_folder(key), ignore_errors=True)
+            total -= entry['size']
+            del index[key]
+
+stage_cache = StageCache(config.STAGE_CACHE_FOLDER, config.STAGE_CACHE_MB * 1024 * 1024)
@@ -0,0 +1,103 @@
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from flask import request, jsonify, send_file, Response, Blueprint
+from flask_cors import CORS
+from werkzeug.utils import safe_join
+
+from api import config
+
+stream = Blueprint('stream', __name__)
+CORS(stream)  # Enable CORS for cross-origin requests from the Next.js front end
+public_output_folder = os.path.join('public/', 'output/')
+chunk_size = 64 * 1024
+
+# Sidecar file present while a video is written, so the server knows the file will grow even when the render runs in
+# a job worker process
+def rendering_marker(video_filepath):
+    return f"{video_filepath}.rendering"
+
+def is_rendering(video_filepath):
+    return os.path.exists(rendering_marker(video_filepath))
+
+# A video rendered again is removed first, a reader would otherwise get the start of the old one before the new bytes
+@contextmanager
+def streaming(video_filepath, enabled=True):
+    if not enabled:
+        yield
+        return
+    marker = rendering_marker(video_filepath)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    if os.path.exists(video_filepath):
+        os.remove(video_filepath)
+    open(marker, "w").close()
+    try:
+        yield
+    finally:
+        if os.path.exists(marker):
+            os.remove(marker)
+
+# Bytes from start to end included, or to the end of the render, waiting for the encoder when reading faster than it writes
+def read_growing(filepath, start, end=None):
+    position = start
+    last_data = time.time()
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        while end is None or position <= end:
+            # Checked before reading so the bytes written right before the render ended are still read
+            rendering = is_rendering(filepath)
+            data = f.read(chunk_size if end is None else min(chunk_size, end - position + 1))
+            if data:
+                position += len(data)
+                last_data = time.time()
+                yield data
+                continue
+            if not rendering or time.time() - last_data > config.STREAM_IDLE_TIMEOUT:
+                break
+            time.sleep(config.STREAM_POLL_INTERVAL)
+
+# Wait for the first bytes after start, returns False if the render ended or stalled before
+def wait_for_bytes(filepath, start):
+    waited = 0.0
+    while not os.path.exists(filepath) or os.path.getsize(filepath) <= start:
+        if not is_rendering(filepath) or waited > config.STREAM_IDLE_TIMEOUT:
+            return os.path.exists(filepath) and os.path.getsize(filepath) > start
+        time.sleep(config.STREAM_POLL_INTERVAL)
+        waited += config.STREAM_POLL_INTERVAL
+    return True
+
+def parse_range(header):
+    match = re.fullmatch(r"bytes=(\d+)-(\d*)", (header or "").strip())
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)) if match.group(2) else None
+
+# Videos in public/output/, also while they're still rendered with stream enabled. Finished videos are served with the
+# usual range support. While rendering, a request from the start follows the file until the render ends, and a range
+# request gets the bytes of the range already written, with an unknown total length.
+@stream.route('/api/stream/<path:filename>', methods=['GET'])
+def stream_video(filename):
+    filepath = safe_join(public_output_folder, filename)
+    if filepath is None:
+        return jsonify({'error': 'Video not found'}), 404
+
+    byte_range = parse_range(request.headers.get('Range'))
+    start = byte_range[0] if byte_range else 0
+    if not wait_for_bytes(filepath, start):
+        return jsonify({'error': 'Video not found'}), 404
+
+    if not is_rendering(filepath):
+        return send_file(os.path.abspath(filepath), conditional=True)
+
+    headers = {'Accept-Ranges': 'bytes', 'Cache-Control': 'no-cache'}
+    if start == 0 and (byte_range is None or byte_range[1] is None):
+        return Response(read_growing(filepath, 0), status=200, mimetype='video/mp4', headers=headers)
+
+    # Only the bytes already written are promised, the render could end before the end of the requested range
+    end = os.path.getsize(filepath) - 1
+    if byte_range[1] is not None:
+        end = min(end, byte_range[1])
+    headers['Content-Range'] = f"bytes {start}-{end}/*"
+    return Response(read_growing(filepath, start, end), status=206, mimetype='video/mp4', headers=headers)
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from moviepy.editor import TextClip, ImageClip
+
+from api import config
+
+# Content-addressed cache of rasterized TextClips, with a RAM tier and an on-disk tier both evicted in LRU order
+class TextCache:
+    def __init__(self, folder, max_memory_bytes, max_disk_bytes):
+        self.folder = folder
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.rasterize_time = 0.0
+
+    @staticmethod
+    def make_key(txt, **kwargs):
+        description = json.dumps({"text": txt, **kwargs}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+
+        item = self._read_disk(key)
+        if item is not None:
+            with self.lock:
+                self.disk_hits += 1
+            self._store_memory(key, item)
+        return item
+
+    def put(self, key, frame, mask=None):
+        item = (frame, mask)
+        self._store_memory(key, item)
+        self._write_disk(key, item)
+        return item
+
+    def get_or_render(self, txt, **kwargs):
+        key = self.make_key(txt, **kwargs)
+        item = self.get(key)
+        if item is not None:
+            return item
+
+        rasterize_start = time.time()
+        clip = TextClip(txt, **kwargs)
+        frame = clip.get_frame(0)
+        mask = clip.mask.get_frame(0) if clip.mask is not None else None
+        rasterize_time = time.time() - rasterize_start
+
+        with self.lock:
+            self.misses += 1
+            self.rasterize_time += rasterize_time
+        return self.put(key, frame, mask)
+
+    def stats(self, since=None):
+        with self.lock:
+            stats = {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "rasterize_time": self.rasterize_time
+            }
+        if since is not None:
+            stats = {k: v - since[k] for k, v in stats.items()}
+
+        # Time saved is estimated from the average time it takes ImageMagick to rasterize a text
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        average_rasterize_time = self.rasterize_time / self.misses if self.misses > 0 else 0.0
+        stats["hits"] = hits
+        stats["saved_time"] = hits * average_rasterize_time
+        return stats
+
+    def _store_memory(self, key, item):
+        size = sum(a.nbytes for a in item if a is not None)
+        if size > self.max_memory_bytes:
+            return
+
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+            self.memory[key] = item
+            self.memory_bytes += size
+            while self.memory_bytes > self.max_memory_bytes:
+                _, (frame, mask) = self.memory.popitem(last=False)
+                self.memory_bytes -= frame.nbytes + (mask.nbytes if mask is not None else 0)
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.npz")
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                frame = data["frame"]
+                mask = data["mask"] if "mask" in data else None
+            # Touch the file so the disk tier evicts the least recently used entries first
+            os.utime(path)
+            return (frame, mask)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, item):
+        if self.max_disk_bytes <= 0:
+            return
+        frame, mask = item
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                if mask is not None:
+                    np.savez_compressed(f, frame=frame, mask=mask)
+                else:
+                    np.savez_compressed(f, frame=frame)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = self._scan_disk_size()
+            else:
+                self.disk_bytes += size
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _scan_disk_size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.folder) if entry.name.endswith(".npz"))
+
+    def _evict_disk(self):
+        # Other processes can share the folder, so the size is recomputed from the folder content
+        entries = [entry for entry in os.scandir(self.folder) if entry.name.endswith(".npz")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_disk_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        self.disk_bytes = total
+
+text_cache = TextCache(config.TEXT_CACHE_FOLDER, config.TEXT_CACHE_MEMORY_MB * 1024 * 1024, config.TEXT_CACHE_DISK_MB * 1024 * 1024)
+
+# Text styles are TextClip options, with an optional stroke color used for "[pause]" placeholders
+def text_options(txt, style):
+    options = {k: v for k, v in style.items() if k != "pause_stroke_color"}
+    if txt == "[pause]" and "pause_stroke_color" in style:
+        options["stroke_color"] = style["pause_stroke_color"]
+    return options
+
+def rasterize_text(txt, style):
+    return text_cache.get_or_render(txt, **text_options(txt, style))
+
+# Drop-in replacement for TextClip that only runs ImageMagick for texts that were never rendered before
+def cached_text_clip(txt, **kwargs):
+    frame, mask = text_cache.get_or_render(txt, **kwargs)
+    clip = ImageClip(frame)
+    if mask is not None:
+        clip = clip.set_mask(ImageClip(mask, ismask=True))
+    return clip
+
+def text_generator(style):
+    return lambda txt: cached_text_clip(txt, **text_options(txt, style))
@@ -0,0 +1,68 @@
+import numpy as np
+
+# Compiled version of the blue rectangle movement dicts, with random access to the rectangle position of any frame.
+# The positions are the ones of the original frame by frame scan, which moved on by at most one word per frame, on the
+# first frame at or after the end of the word it was on.
+class HighlightTimeline:
+    def __init__(self, starts, ends, old_x, new_x):
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.ends = np.asarray(ends, dtype=np.float64)
+        self.old_x = np.asarray(old_x, dtype=np.float64)
+        self.new_x = np.asarray(new_x, dtype=np.float64)
+        self._passing_frames = {}
+
+    @classmethod
+    def from_dicts(cls, rect_dict_list):
+        return cls(
+            [d["start"] for d in rect_dict_list],
+            [d["end"] for d in rect_dict_list],
+            [d["old_x"] for d in rect_dict_list],
+            [d["new_x"] for d in rect_dict_list]
+        )
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Frame on which the scan moves past each word but the last: the first frame at or after the end of the word, and
+    # at least one frame after the one it moved past the previous word on
+    def passing_frames(self, fps):
+        if fps not in self._passing_frames:
+            ends = self.ends[:-1]
+            first = np.ceil(ends * fps).astype(np.int64)
+            # Same comparison as the scan, on the same floats
+            first = np.where((first - 1) / float(fps) >= ends, first - 1, first)
+            first = np.where(first / float(fps) < ends, first + 1, first)
+            first = np.maximum(first, 0)
+            order = np.arange(len(first))
+            self._passing_frames[fps] = order + np.maximum.accumulate(first - order) if len(first) > 0 else first
+        return self._passing_frames[fps]
+
+    def positions(self, frames, fps):
+        frames = np.asarray(frames, dtype=np.int64)
+        if len(self) == 0:
+            return np.zeros(frames.shape)
+
+        times = frames / float(fps)
+        # Word the scan is on at the start of each frame, the number of words it moved past on the frames before
+        word = np.searchsorted(self.passing_frames(fps), frames, side="left")
+        last = word == len(self) - 1
+        start = self.starts[word]
+        end = self.ends[word]
+        after = word + ((~last) & (times >= end))
+
+        # Like np.interp(t, [start, end], [old_x, new_x]) for t between start and end
+        old_x, new_x = self.old_x[word], self.new_x[word]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            interpolated = np.where(times == end, new_x, old_x + (new_x - old_x) / (end - start) * (times - start))
+
+        # Outside of the word, the rectangle is at the end of the word before the one the scan moves to, or of the last
+        # word once it got there, and at 0 before it moved past the first word
+        previous = np.where(last, word, np.maximum(after - 1, 0))
+        x = np.where(after > 0, self.new_x[previous], 0.0)
+        return np.where((start <= times) & (times <= end), interpolated, x)
+
+    def x_at_frame(self, frame_index, fps):
+        return float(self.positions([frame_index], fps)[0])
+
+    def frame_positions(self, fps, first_frame, last_frame):
+        return self.positions(np.arange(first_frame, last_frame), fps)
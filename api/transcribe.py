@@ -1,11 +1,18 @@
 import os
 import time
 import json
-from flask import request, jsonify, Blueprint
+import importlib
+import threading
+import types
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from flask import request, Blueprint
 from flask_cors import CORS
-import torch
 
+import tqdm
+import numpy as np
 import whisper_timestamped as whisper
+from whisper.audio import N_SAMPLES, log_mel_spectrogram, pad_or_trim
 
 # Libraries WER calculation
 import asyncio
@@ -14,6 +21,14 @@ from lyricsgenius import Genius
 from jiwer import wer
 import cutlet
 
+from api import config
+from api.models import whisper_models, default_device, init_transcription_worker, take_transcription_worker_load_time
+from api.audio import split_on_silence, active_regions, RegionTimeline
+from api.stage_cache import stage_cache, stage_key, audio_fingerprint
+from api.metrics import span, record_span
+from api.progress import InvalidRequest, no_progress
+from api.jobs import run_job_and_respond
+
 transcribe = Blueprint("transcribe", __name__)
 CORS(transcribe)  # Enable CORS for cross-origin requests from the Next.js front end
 output_folder = 'output/'
@@ -58,33 +73,262 @@ def compare_lyrics(filename, hypothesis, lang):
     asyncio.set_event_loop(loop)
     loop.run_until_complete(get_and_compare_lyrics(filename, hypothesis, lang))
 
-@transcribe.route('/api/transcribe', methods=['POST'])
-def transcribe_audio():
-    vocals_filename = request.form.get('vocals_filename')
+# Whisper reports its progress over the audio windows through tqdm, forward it to the progress callback of the current thread
+progress_local = threading.local()
+
+class WhisperProgressBar(tqdm.tqdm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.done = 0
+
+    def update(self, n=1):
+        super().update(n)
+        self.done += n
+        callback = getattr(progress_local, 'callback', None)
+        if callback is not None and self.total:
+            callback('transcribing', min(100.0, 100.0 * self.done / self.total))
+
+importlib.import_module('whisper.transcribe').tqdm = types.SimpleNamespace(tqdm=WhisperProgressBar)
+
+whisper_samplerate = 16000
+# Whisper seeks are counted in mel frames of 160 samples
+whisper_hop_length = 160
+
+def parallel_transcription():
+    return config.TRANSCRIBE_WORKERS > 1 and default_device() == "cpu"
+
+# Approximate float32 size of the Whisper models in MB, to fit their copies in the memory budget before loading them
+whisper_model_mb = {'tiny': 160, 'base': 300, 'small': 980, 'medium': 3080, 'turbo': 3240, 'large': 6200}
+
+def whisper_model_name(model_size):
+    return 'turbo' if 'turbo' in model_size else model_size.split('.')[0].split('-')[0]
+
+# Number of chunk workers and torch threads of each. Job worker processes each have their own chunk pool (job threads
+# share one), the cores and the memory budget for the copies of the model are divided between them.
+def chunk_pool_size(model_size):
+    pools = max(1, config.JOB_WORKERS) if config.JOB_EXECUTOR == "process" else 1
+    workers = max(1, config.TRANSCRIBE_WORKERS // pools)
+    model_mb = whisper_model_mb.get(whisper_model_name(model_size))
+    if model_mb:
+        workers = max(1, min(workers, config.WHISPER_MEMORY_BUDGET_MB // pools // model_mb))
+    threads = max(1, (os.cpu_count() or 1) // (pools * workers))
+    return workers, threads
+
+# Chunk transcription pools, kept between jobs so the workers stay warm
+chunk_executors = {}
+chunk_executors_lock = threading.Lock()
+
+# The pool of the model, and for a new pool the tasks starting its workers, which return the time they took to load it
+def chunk_executor(model_size):
+    with chunk_executors_lock:
+        if model_size in chunk_executors:
+            return chunk_executors[model_size], []
+        # Not forked from this process, whose torch threads and locks may be in use, each worker loads its own model
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        workers, threads = chunk_pool_size(model_size)
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_transcription_worker, initargs=(model_size, threads))
+        # The pool only starts a process for a task, one task per worker has them all load the model at the same time
+        starting = [executor.submit(take_transcription_worker_load_time) for _ in range(workers)]
+        chunk_executors[model_size] = executor
+        return executor, starting
+
+# Runs in a chunk transcription process: the language of the first 30 seconds, detected like Whisper does for a whole song
+def detect_language(audio, model_size):
+    with whisper_models.use(model_size, "cpu") as (whisper_model, _):
+        mel = log_mel_spectrogram(pad_or_trim(audio), whisper_model.dims.n_mels).to(whisper_model.device)
+        _, probabilities = whisper_model.detect_language(mel)
+        return max(probabilities, key=probabilities.get), take_transcription_worker_load_time()
+
+# Runs in a chunk transcription process
+def transcribe_chunk(audio, model_size, language):
+    with whisper_models.use(model_size, "cpu") as (whisper_model, _):
+        return whisper.transcribe_timestamped(whisper_model, audio, language=language), take_transcription_worker_load_time()
+
+# Put the chunk transcriptions back together, with their timestamps moved to the position of the chunk in the song
+def merge_transcriptions(results, offsets, language):
+    segments = []
+    for result, offset in zip(results, offsets):
+        offset_seconds = offset / float(whisper_samplerate)
+        for segment in result['segments']:
+            segment['id'] = len(segments)
+            segment['seek'] += offset // whisper_hop_length
+            segment['start'] = round(segment['start'] + offset_seconds, 2)
+            segment['end'] = round(segment['end'] + offset_seconds, 2)
+            for word in segment.get('words', []):
+                word['start'] = round(word['start'] + offset_seconds, 2)
+                word['end'] = round(word['end'] + offset_seconds, 2)
+            segments.append(segment)
+
+    return {
+        'text': "".join(result['text'] for result in results),
+        'segments': segments,
+        'language': language
+    }
+
+def transcribe_parallel(audio, model_size, progress=no_progress):
+    chunks = split_on_silence(audio, whisper_samplerate, config.TRANSCRIBE_CHUNK_SECONDS)
+    progress('loading model', 0)
+    executor, starting = chunk_executor(model_size)
+    # Measured in the workers, which load the model at the same time
+    load_times = [future.result() for future in starting]
+
+    progress('transcribing', 0)
+    inference_start = time.time()
+    # Detected once so every chunk is transcribed in the same language, a chunk alone could be taken for another one
+    with span('language detection', model=model_size):
+        language, load_time = executor.submit(detect_language, audio[:N_SAMPLES], model_size).result()
+    late_load_times = [load_time]
+    futures = {executor.submit(transcribe_chunk, audio[start:end], model_size, language): i for i, (start, end) in enumerate(chunks)}
+    results = [None] * len(chunks)
+    done = 0
+    for future in as_completed(futures):
+        i = futures[future]
+        results[i], load_time = future.result()
+        late_load_times.append(load_time)
+        done += chunks[i][1] - chunks[i][0]
+        progress('transcribing', 100.0 * done / max(len(audio), 1))
+    # A worker that didn't get one of the starting tasks loaded the model during the transcription
+    late_load_time = max(late_load_times)
+    model_load_time = max(load_times + [late_load_time])
+    inference_time = max(0.0, time.time() - inference_start - late_load_time)
+    record_span('load model', model_load_time, model=model_size)
+    record_span('inference', inference_time, model=model_size, chunks=len(chunks))
+
+    return merge_transcriptions(results, [start for start, _ in chunks], language), model_load_time, inference_time
+
+# Transcribe 16 kHz mono float32 samples, like the ones returned by whisper.load_audio
+def transcribe_array(audio, model_size, progress=no_progress):
+    if parallel_transcription():
+        return transcribe_parallel(audio, model_size, progress)
+
+    progress('loading model', 0)
+    with whisper_models.use(model_size) as (whisper_model, model_load_time):
+        record_span('load model', model_load_time, model=model_size)
+        progress('transcribing', 0)
+        inference_start = time.time()
+        progress_local.callback = progress
+        try:
+            with span('inference', model=model_size):
+                transcription_result = whisper.transcribe_timestamped(whisper_model, audio)
+        finally:
+            progress_local.callback = None
+        inference_time = time.time() - inference_start
+    return transcription_result, model_load_time, inference_time
+
+# Move the timestamps of a transcription of the active regions back to their position in the whole stem
+def shift_transcription(transcription_result, timeline):
+    for segment in transcription_result['segments']:
+        segment['seek'] = int(round(timeline.original_time(segment['seek'] * whisper_hop_length / whisper_samplerate) * whisper_samplerate / whisper_hop_length))
+        segment['start'] = round(timeline.original_time(segment['start']), 2)
+        segment['end'] = round(timeline.original_time(segment['end']), 2)
+        for word in segment.get('words', []):
+            word['start'] = round(timeline.original_time(word['start']), 2)
+            word['end'] = round(timeline.original_time(word['end']), 2)
+
+# Transcribe only the regions where the vocals are active, the intros, solos and outros are skipped
+def transcribe_voiced(audio, model_size, progress=no_progress):
+    regions = []
+    if config.VAD != "off":
+        progress('detecting voice', 0)
+        with span('voice detection'):
+            regions = active_regions(audio, whisper_samplerate, config.VAD_TOP_DB, config.VAD_MIN_SILENCE, config.VAD_PADDING)
+
+    if not regions or regions == [(0, len(audio))]:
+        voiced = audio
+    else:
+        voiced = np.concatenate([audio[start:end] for start, end in regions])
+    transcription_result, model_load_time, inference_time = transcribe_array(voiced, model_size, progress)
+    if voiced is not audio:
+        shift_transcription(transcription_result, RegionTimeline(regions, whisper_samplerate))
+
+    transcribed_duration = len(voiced) / float(whisper_samplerate)
+    skipped_duration = (len(audio) - len(voiced)) / float(whisper_samplerate)
+    vad = {
+        'skipped_duration': skipped_duration,
+        'transcribed_duration': transcribed_duration,
+        # Estimated from the inference speed on the transcribed audio
+        'time_saved': inference_time * skipped_duration / transcribed_duration if transcribed_duration > 0 else 0.0
+    }
+    return transcription_result, model_load_time, inference_time, vad
+
+# Everything that changes the transcription of a vocals stem
+def transcription_options():
+    options = {}
+    if parallel_transcription():
+        options['chunk_seconds'] = config.TRANSCRIBE_CHUNK_SECONDS
+    if config.VAD != "off":
+        options['vad'] = [config.VAD, config.VAD_TOP_DB, config.VAD_MIN_SILENCE, config.VAD_PADDING]
+    return options
+
+def transcription_key(fingerprint, model_size):
+    return stage_key('transcribe', fingerprint, {'model': model_size, **transcription_options()})
+
+def transcribe_vocals(vocals_filename, base_filename, model_size, progress=no_progress):
     vocals_filepath = os.path.join(tmp_folder, vocals_filename)
 
-    try:
-        transc_start = time.time()
+    transcription_filename = f"{base_filename}.json"
+    transcription_path = os.path.join(tmp_folder, transcription_filename)
+
+    transc_start = time.time()
+    progress('looking up cache', 0)
+    with span('cache lookup'):
+        cache_key = transcription_key(audio_fingerprint(vocals_filepath), model_size)
+        cache_hit = stage_cache.lookup(cache_key) is not None
+        if cache_hit:
+            stage_cache.restore(cache_key, 'transcription.json', transcription_path)
+    if cache_hit:
+        return {
+            'transcription': transcription_filename,
+            'transc_time': time.time() - transc_start,
+            'model_load_time': 0.0,
+            'inference_time': 0.0,
+            'vad': None,
+            'cache_hit': True
+        }
+
+    progress('loading audio', 0)
+    with span('load audio'):
         audio = whisper.load_audio(vocals_filepath)
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        whisper_model = whisper.load_model("medium", device=device)
+    transcription_result, model_load_time, inference_time, vad = transcribe_voiced(audio, model_size, progress)
 
-        transcription_result = whisper.transcribe_timestamped(whisper_model, audio)
-        transcription_filename = f"{request.form.get('base_filename')}.json"
-        transcription_path = os.path.join(tmp_folder, transcription_filename)
+    with span('cache store'):
+        transcription_json = json.dumps(transcription_result)
         with open(transcription_path, "w") as f:
-            json.dump(transcription_result, f)
+            f.write(transcription_json)
+        stage_cache.store(cache_key, 'transcribe', contents={'transcription.json': transcription_json.encode("utf-8")})
 
-        transc_end = time.time()
-        transc_time = transc_end - transc_start
+    transc_end = time.time()
+    transc_time = transc_end - transc_start
 
-        # WER calculation (optional)
-        # compare_lyrics(filename, transcription_result["text"], transcription_result["language"])
+    # WER calculation (optional)
+    # compare_lyrics(filename, transcription_result["text"], transcription_result["language"])
 
-        return jsonify({
-            'transcription': transcription_filename,
-            'transc_time': transc_time
-        }), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+    return {
+        'transcription': transcription_filename,
+        'transc_time': transc_time,
+        'model_load_time': model_load_time,
+        'inference_time': inference_time,
+        'vad': vad,
+        'cache_hit': False
+    }
+
+def transcription_params():
+    vocals_filename = request.form.get('vocals_filename')
+    if not vocals_filename:
+        raise InvalidRequest('Missing vocals_filename in the request')
+    return {
+        'vocals_filename': vocals_filename,
+        'base_filename': request.form.get('base_filename'),
+        'model_size': request.form.get('whisper_model', config.WHISPER_MODEL)
+    }
+
+def run_transcription(params, progress=no_progress):
+    return transcribe_vocals(params['vocals_filename'], params['base_filename'], params['model_size'], progress)
+
+@transcribe.route('/api/transcribe', methods=['POST'])
+def transcribe_audio():
+    return run_job_and_respond('transcribe')
@@ -0,0 +1,213 @@
+import numpy as np
+
+# Segment values of the whisper_timestamped output copied to every segment split from it
+segment_fields = ('seek', 'temperature', 'avg_logprob', 'compression_ratio', 'no_speech_prob', 'confidence')
+
+# Columnar transcription: the word timings live in arrays, the word texts in one string with their offsets,
+# and the segments are ranges of words. The splitting transforms only build new ranges, the words are shared.
+class Transcript:
+    def __init__(self, words_text, word_offsets, starts, ends, confidences, segments, metadata, info):
+        self.words_text = words_text
+        self.word_offsets = word_offsets
+        self.starts = starts
+        self.ends = ends
+        self.confidences = confidences
+        self.metadata = metadata
+        self.info = info
+
+        # One row per segment: (id, first word, last word + 1, start, end, metadata index, text, joiner).
+        # The text is None when it's the words joined with the joiner.
+        ids, first_words, end_words, segment_starts, segment_ends, metadata_indices, texts, joiners = zip(*segments) if segments else ([],) * 8
+        self.ids = np.array(ids, dtype=np.int64)
+        self.first_words = np.array(first_words, dtype=np.int64)
+        self.end_words = np.array(end_words, dtype=np.int64)
+        self.segment_starts = np.array(segment_starts, dtype=np.float64)
+        self.segment_ends = np.array(segment_ends, dtype=np.float64)
+        self.metadata_indices = np.array(metadata_indices, dtype=np.int64)
+        self.texts = list(texts)
+        self.joiners = list(joiners)
+
+    @classmethod
+    def from_whisper(cls, transcription_result):
+        words_text = []
+        word_offsets = [0]
+        starts = []
+        ends = []
+        confidences = []
+        segments = []
+        metadata = []
+        for segment in transcription_result['segments']:
+            first_word = len(starts)
+            for word in segment['words']:
+                words_text.append(word['text'])
+                word_offsets.append(word_offsets[-1] + len(word['text']))
+                starts.append(word['start'])
+                ends.append(word['end'])
+                confidences.append(word['confidence'])
+            segments.append((segment['id'], first_word, len(starts), segment['start'], segment['end'], len(metadata), segment['text'], ""))
+            metadata.append({field: segment[field] for field in segment_fields})
+
+        info = {key: value for key, value in transcription_result.items() if key != 'segments'}
+        return cls("".join(words_text), np.array(word_offsets, dtype=np.int64), np.array(starts, dtype=np.float64), np.array(ends, dtype=np.float64),
+                   np.array(confidences, dtype=np.float64), segments, metadata, info)
+
+    # Same words, other segments
+    def with_segments(self, segments):
+        return Transcript(self.words_text, self.word_offsets, self.starts, self.ends, self.confidences, segments, self.metadata, self.info)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def word_text(self, k):
+        return self.words_text[self.word_offsets[k]:self.word_offsets[k + 1]]
+
+    def segment_text(self, s):
+        if self.texts[s] is not None:
+            return self.texts[s]
+        first_word, end_word = self.first_words[s], self.end_words[s]
+        if self.joiners[s] == "":
+            return self.words_text[self.word_offsets[first_word]:self.word_offsets[end_word]]
+        return self.joiners[s].join(self.word_text(k) for k in range(first_word, end_word))
+
+    def segment_row(self, s):
+        return (int(self.ids[s]), int(self.first_words[s]), int(self.end_words[s]), float(self.segment_starts[s]), float(self.segment_ends[s]),
+                int(self.metadata_indices[s]), self.texts[s], self.joiners[s])
+
+    def word(self, k):
+        return {'text': self.word_text(k), 'start': float(self.starts[k]), 'end': float(self.ends[k]), 'confidence': float(self.confidences[k])}
+
+    def segment(self, s):
+        metadata = self.metadata[self.metadata_indices[s]]
+        return {
+            "id": int(self.ids[s]),
+            "seek": metadata["seek"],
+            "start": float(self.segment_starts[s]),
+            "end": float(self.segment_ends[s]),
+            "text": self.segment_text(s),
+            "temperature": metadata["temperature"],
+            "avg_logprob": metadata["avg_logprob"],
+            "compression_ratio": metadata["compression_ratio"],
+            "no_speech_prob": metadata["no_speech_prob"],
+            "confidence": metadata["confidence"],
+            "words": [self.word(k) for k in range(self.first_words[s], self.end_words[s])]
+        }
+
+    def segments(self):
+        return [self.segment(s) for s in range(len(self))]
+
+    def to_whisper(self):
+        return {**self.info, 'segments': self.segments()}
+
+def is_kanji(char):
+    code_point = ord(char)
+    if 0x4E00 <= code_point <= 0x9FFF or \
+       0x3400 <= code_point <= 0x4DBF or \
+       0x20000 <= code_point <= 0x2A6DF:
+        return True
+    return False
+
+# Function to split big sentences in latin languages
+def split_text(transcript, lang):
+    segments = []
+    i = 0
+    for s in range(len(transcript)):
+        first_word, end_word = int(transcript.first_words[s]), int(transcript.end_words[s])
+        metadata_index = int(transcript.metadata_indices[s])
+        if first_word == end_word:
+            continue
+        current = first_word
+        word_count = 0
+        for k in range(first_word + 1, end_word):
+            first_char = transcript.word_text(k)[:1]
+            word_count += 1
+            if (lang != "en" and first_char.isupper() or lang == "en" and first_char.isupper() and first_char != "I") or (word_count > 4 and end_word - k > 2):
+                segments.append((i, current, k, transcript.starts[current], transcript.ends[k - 1], metadata_index, None, " "))
+                current = k
+                word_count = 1
+                i += 1
+        segments.append((i, current, end_word, transcript.starts[current], transcript.ends[end_word - 1], metadata_index, None, " "))
+
+    return transcript.with_segments(segments)
+
+# Split Japanese lines longer than 12 characters every 10 characters, without cutting through kanji compounds
+def split_text_ja(transcript):
+    i = 0
+    segments = []
+    for s in range(len(transcript)):
+        text = transcript.segment_text(s)
+        first_word, end_word = int(transcript.first_words[s]), int(transcript.end_words[s])
+        metadata_index = int(transcript.metadata_indices[s])
+        nb_words = end_word - first_word
+        # Number of characters up to the end of each word, to find the word of a split point
+        word_ends = transcript.word_offsets[first_word + 1:end_word + 1] - transcript.word_offsets[first_word]
+
+        def piece_start(begin):
+            return transcript.starts[first_word + begin] if begin < nb_words else transcript.segment_starts[s]
+
+        char_list_len = len(text)
+        begin = 0
+        split_index = -1
+
+        while char_list_len >= 13:
+            split_index += 10
+            remove = 10
+            while(split_index + 1 < char_list_len and is_kanji(text[split_index]) and is_kanji(text[split_index+1])):
+                split_index += 1
+                remove += 1
+
+            if split_index >= char_list_len:
+                split_index = char_list_len - 1
+
+            index_last_word = int(np.searchsorted(word_ends, split_index, side='left'))
+            last_word = index_last_word - 1 if index_last_word > 0 else nb_words - 1
+            segments.append((i, first_word + begin, first_word + max(begin, index_last_word), piece_start(begin), transcript.ends[first_word + last_word], metadata_index, None, ""))
+
+            i += 1
+            begin = index_last_word
+            char_list_len -= remove
+
+        if char_list_len > 0:
+            segments.append((i, first_word + begin, end_word, piece_start(begin), transcript.segment_ends[s], metadata_index, None, ""))
+            i += 1
+
+    return transcript.with_segments(segments)
+
+# Split Japanese lines at the space words, which are dropped
+def split_text_spaces_1_ja(transcript):
+    segments = []
+    id = 0
+
+    for s in range(len(transcript)):
+        first_word, end_word = int(transcript.first_words[s]), int(transcript.end_words[s])
+        metadata_index = int(transcript.metadata_indices[s])
+        spaces = [k for k in range(first_word, end_word) if transcript.word_text(k) == ' ']
+
+        if spaces:
+            for begin, end in zip([first_word] + [k + 1 for k in spaces], spaces + [end_word]):
+                if begin == end:
+                    continue
+                segments.append((id, begin, end, transcript.starts[begin], transcript.ends[end - 1], metadata_index, None, ""))
+                id += 1
+        else:
+            segments.append(transcript.segment_row(s))
+            id += 1
+
+    return transcript.with_segments(segments)
+
+def remove_spaces_ja(transcript):
+    segments = []
+    for s in range(len(transcript)):
+        row = transcript.segment_row(s)
+        text = transcript.segment_text(s)
+        if " " in text and (row[6] is not None or row[7] != ""):
+            row = row[:6] + (text.replace(" ", ""), row[7])
+        segments.append(row)
+
+    if " " not in transcript.words_text:
+        return transcript.with_segments(segments)
+
+    # Rebuild the text buffer without the spaces, the timings are shared
+    words_text = [transcript.word_text(k).replace(" ", "") for k in range(len(transcript.starts))]
+    word_offsets = np.zeros(len(words_text) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in words_text], out=word_offsets[1:])
+    return Transcript("".join(words_text), word_offsets, transcript.starts, transcript.ends, transcript.confidences, segments, transcript.metadata, transcript.info)
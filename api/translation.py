@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from api import config
+from api.progress import no_progress
+
+# Whisper language codes Google Translate knows under another code
+google_language_aliases = {
+    'zh': 'zh-cn',
+    'yue': 'zh-tw'
+}
+
+# Translates with Google Translate, each worker thread gets its own client since they aren't thread safe
+class GoogleTranslateBackend:
+    def __init__(self):
+        self.local = threading.local()
+
+    def translator(self):
+        if not hasattr(self.local, 'translator'):
+            from googletrans import Translator
+            self.local.translator = Translator()
+        return self.local.translator
+
+    # Whisper's language code as a Google Translate source language, detected by Google when it isn't one of its own
+    def source_language(self, src):
+        from googletrans.constants import LANGUAGES, SPECIAL_CASES
+        src = google_language_aliases.get(src, src)
+        return src if src in LANGUAGES or src in SPECIAL_CASES else 'auto'
+
+    # googletrans sends one request per text of a list, the batch is sent as one text with a line per lyric line. Line
+    # breaks are kept by the translation, when it doesn't give back as many lines they're translated one by one.
+    def translate_batch(self, texts, src, dest):
+        translator = self.translator()
+        src = self.source_language(src)
+        lines = [" ".join(text.splitlines()) for text in texts]
+        translated = translator.translate("\n".join(lines), src=src, dest=dest).text.split("\n")
+        if len(translated) == len(lines):
+            return [line.strip() for line in translated]
+        return [translator.translate(line, src=src, dest=dest).text for line in lines]
+
+# Local stand-in returning the texts unchanged (or tagged with the target language), to run without network
+class LoopbackBackend:
+    def __init__(self, tag=False):
+        self.tag = tag
+
+    def translate_batch(self, texts, src, dest):
+        return [f"[{dest}] {text}" if self.tag else text for text in texts]
+
+backends = {
+    'google': GoogleTranslateBackend,
+    'loopback': LoopbackBackend
+}
+
+# Translations keyed by (text, source language, target language), evicted in LRU order past the entry limit
+class TranslationCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text, src, dest):
+        key = (text, src, dest)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, text, src, dest, translation):
+        if self.max_entries <= 0:
+            return
+        key = (text, src, dest)
+        with self.lock:
+            self.entries[key] = translation
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+translation_cache = TranslationCache(config.TRANSLATION_CACHE_SIZE)
+translation_backend = backends[config.TRANSLATION_BACKEND]()
+
+def set_translation_backend(backend):
+    global translation_backend
+    translation_backend = backend
+
+# Translate every text at once, only the lines missing from the cache are sent, in batches translated concurrently
+def translate_texts(texts, src, dest, progress=no_progress, backend=None, cache=None, batch_size=None, max_workers=None):
+    backend = backend or translation_backend
+    cache = cache or translation_cache
+    batch_size = max(1, batch_size or config.TRANSLATION_BATCH_SIZE)
+    max_workers = max(1, max_workers or config.TRANSLATION_WORKERS)
+
+    translations = {}
+    missing = []
+    for text in dict.fromkeys(texts):
+        cached = cache.get(text, src, dest)
+        if cached is not None:
+            translations[text] = cached
+        else:
+            missing.append(text)
+
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    if batches:
+        progress('translating', 0)
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            for i, (batch, results) in enumerate(zip(batches, executor.map(lambda batch: backend.translate_batch(batch, src, dest), batches))):
+                for text, translation in zip(batch, results):
+                    cache.put(text, src, dest, translation)
+                    translations[text] = translation
+                progress('translating', 100 * (i + 1) / len(batches))
+
+    return [translations[text] for text in texts]
@@ -0,0 +1,77 @@
+import json
+import os
+import re
+
+upload_folder = 'uploads/'
+# Downloaded audio is kept as <video id>.<ext> so a video is only downloaded once
+youtube_folder = os.path.join(upload_folder, 'youtube/')
+
+def is_youtube_link(link):
+    youtube_regex = (
+        r'(https?://)?(www\.)?'
+        r'(youtube\.com/watch\?v=|youtu\.be/)'
+        r'[^\s]{11}'
+    )
+    return re.match(youtube_regex, link) is not None
+
+def youtube_video_id(link):
+    match = re.search(r'(?:youtube\.com/watch\?(?:.*&)?v=|youtu\.be/)([A-Za-z0-9_-]{11})', link)
+    return match.group(1) if match else None
+
+def sanitize_filename(filename):
+    return filename.replace("/", "_").replace("\\", "_").replace(":", "_").replace("*", "_").replace("?", "_").replace("\"", "_").replace("<", "_").replace(">", "_").replace("|", "_").replace("#", "_")
+
+# Any object with the YoutubeDL interface can be used instead, e.g. a local stand-in to run without network
+def default_extractor(options):
+    import yt_dlp
+    return yt_dlp.YoutubeDL(options)
+
+def cache_entry_path(video_id):
+    return os.path.join(youtube_folder, f"{video_id}.json")
+
+def read_download_cache(video_id):
+    if video_id is None:
+        return None
+    try:
+        with open(cache_entry_path(video_id), "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(os.path.join(upload_folder, entry['filename'])):
+        return None
+    return entry
+
+def write_download_cache(video_id, title, filename):
+    entry = {'id': video_id, 'title': title, 'filename': filename}
+    with open(cache_entry_path(video_id), "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    return entry
+
+# Download the best native audio stream of a video, returns its path relative to the upload folder and its title
+def download_youtube_audio(url, extractor=default_extractor):
+    entry = read_download_cache(youtube_video_id(url))
+    if entry is not None:
+        return entry['filename'], sanitize_filename(entry['title'])
+
+    os.makedirs(youtube_folder, exist_ok=True)
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'format': 'bestaudio/best',
+        'outtmpl': os.path.join(youtube_folder, '%(id)s.%(ext)s'),
+    }
+
+    with extractor(ydl_opts) as ydl:
+        # A single extraction gives the id and the title, and is reused for the download
+        info = ydl.extract_info(url, download=False)
+        video_id = info['id']
+        title = info.get('title') or video_id
+
+        entry = read_download_cache(video_id)
+        if entry is None:
+            info = ydl.process_ie_result(info, download=True)
+            downloads = info.get('requested_downloads') or []
+            filepath = downloads[0]['filepath'] if downloads and downloads[0].get('filepath') else ydl.prepare_filename(info)
+            entry = write_download_cache(video_id, title, os.path.relpath(filepath, upload_folder))
+
+    return entry['filename'], sanitize_filename(entry['title'])
@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# Each benchmark runs in its own process so its peak memory isn't mixed with the others.
+# python -m benchmarks.run [--duration 180] [--resolution 1280x720] [--fps 24] [--save-baseline]
+
+benchmarks_folder = os.path.dirname(os.path.abspath(__file__))
+default_baseline = os.path.join(benchmarks_folder, 'baseline.json')
+
+# (benchmark, language, alphabet) run by default, the alphabet only for the benchmarks that build a layout
+default_cases = [
+    ('split_text', 'en', None), ('split_text', 'fr', None), ('split_text_ja', 'ja', None), ('get_furigana_mapping', 'ja', None),
+    ('voice_detection', 'en', None), ('separate_in_chunks', 'en', None),
+    ('render_blue_rectangle', 'en', 'kanjitokana'), ('render_blue_rectangle', 'ja', 'kanjitokana'), ('render_blue_rectangle', 'ja', 'romaji'),
+    ('render_audio', 'en', 'kanjitokana'), ('render_audio', 'fr', 'kanjitokana'), ('render_audio', 'ja', 'kanjitokana'), ('render_audio', 'ja', 'romaji')
+]
+
+# Sample rate whisper loads the vocals at
+whisper_samplerate = 16000
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_split_text(args, transcript):
+    from api.transcript import Transcript, split_text
+    return {'wall_time': best_time(lambda: split_text(Transcript.from_whisper(transcript), args.lang).segments(), args.repeat)}
+
+def bench_split_text_ja(args, transcript):
+    from api.transcript import Transcript, split_text_ja, split_text_spaces_1_ja, remove_spaces_ja
+    def run():
+        split_text_ja(remove_spaces_ja(split_text_spaces_1_ja(Transcript.from_whisper(transcript)))).segments()
+    return {'wall_time': best_time(run, args.repeat)}
+
+def bench_get_furigana_mapping(args, transcript):
+    from api.japanese import get_furigana_mapping, readings
+    def run():
+        # Measure the conversion itself, not the memoized result of the previous run
+        readings.cache_clear()
+        get_furigana_mapping(transcript['text'])
+    return {'wall_time': best_time(run, args.repeat)}
+
+# Voice activity pre-pass and cut of the voiced audio into transcription chunks, on the mono vocals at whisper's rate
+def bench_voice_detection(args, transcript):
+    from benchmarks.synthetic import make_vocals
+    from api import config
+    from api.audio import active_regions, split_on_silence
+
+    audio = make_vocals(transcript, args.duration, whisper_samplerate)[:, 0]
+    def run():
+        regions = active_regions(audio, whisper_samplerate, config.VAD_TOP_DB, config.VAD_MIN_SILENCE, config.VAD_PADDING)
+        voiced = np.concatenate([audio[start:end] for start, end in regions]) if regions else audio
+        split_on_silence(voiced, whisper_samplerate, config.TRANSCRIBE_CHUNK_SECONDS)
+    return {'wall_time': best_time(run, args.repeat)}
+
+# Stands in for the separation model: both stems are the window itself, written where audio-separator writes them
+class PassThroughSeparator:
+    def __init__(self, model_filename):
+        self.base_model_filename = os.path.splitext(model_filename)[0]
+
+    def separate(self, filepath):
+        import soundfile as sf
+        samples, samplerate = sf.read(filepath, dtype='float32', always_2d=True)
+        for name in ('Vocals', 'Instrumental'):
+            sf.write(f"{os.path.splitext(filepath)[0]}_({name})_{self.base_model_filename}.wav", samples, samplerate, subtype='FLOAT')
+
+# Windowed separation of the mix without the model: decoding, crossfades and stem writing, over four windows
+def bench_separate_in_chunks(args, transcript):
+    import soundfile as sf
+    from benchmarks.synthetic import make_instrumental, make_vocals
+    from api import config
+    import api.separate as separation
+
+    config.SEPARATION_CHUNK_SECONDS = args.duration / 4.0
+    with tempfile.TemporaryDirectory() as folder:
+        separation.tmp_folder = folder
+        mix_filepath = os.path.join(folder, 'mix.wav')
+        sf.write(mix_filepath, make_instrumental(args.duration) + make_vocals(transcript, args.duration), 44100)
+        stem_filepaths = {name: os.path.join(folder, f"mix_({name})_model.wav") for name in ('Vocals', 'Instrumental')}
+
+        start = time.perf_counter()
+        separation.separate_in_chunks(PassThroughSeparator('model.onnx'), mix_filepath, 'mix', 'model', stem_filepaths)
+        wall_time = time.perf_counter() - start
+    return {'wall_time': wall_time}
+
+def bench_render_blue_rectangle(args, transcript):
+    from api.render import build_layout, render_blue_rectangle
+    layout = build_layout(transcript, args.duration, args.alphabet, 'null', video_size=args.video_size, fps=args.fps)
+    clip = render_blue_rectangle(layout['rect_dict_list'], layout['base_position'], args.duration, args.fps, args.video_size, layout['font_height'])
+    nb_frames = int(args.duration * args.fps)
+    def run():
+        for i in range(nb_frames):
+            clip.get_frame(i / float(args.fps))
+    wall_time = best_time(run, 1)
+    return {'wall_time': wall_time, 'fps': nb_frames / wall_time}
+
+def bench_render_audio(args, transcript):
+    import soundfile as sf
+    from benchmarks.synthetic import make_instrumental
+    from api.render import build_layout, render_layout
+
+    with tempfile.TemporaryDirectory() as folder:
+        inst_filepath = os.path.join(folder, 'instrumental.wav')
+        sf.write(inst_filepath, make_instrumental(args.duration), 44100)
+        video_filepath = os.path.join(folder, 'video.mp4')
+
+        start = time.perf_counter()
+        layout = build_layout(transcript, args.duration, args.alphabet, 'null', video_size=args.video_size, fps=args.fps)
+        render_layout(layout, inst_filepath, video_filepath, args.render_mode)
+        wall_time = time.perf_counter() - start
+
+    nb_frames = int(args.duration * args.fps)
+    return {'wall_time': wall_time, 'fps': nb_frames / wall_time}
+
+benchmarks = {
+    'split_text': bench_split_text,
+    'split_text_ja': bench_split_text_ja,
+    'get_furigana_mapping': bench_get_furigana_mapping,
+    'voice_detection': bench_voice_detection,
+    'separate_in_chunks': bench_separate_in_chunks,
+    'render_blue_rectangle': bench_render_blue_rectangle,
+    'render_audio': bench_render_audio
+}
+
+def run_worker(args):
+    from benchmarks.synthetic import make_transcript
+    transcript = make_transcript(args.duration, args.lang)
+    result = benchmarks[args.worker](args, transcript)
+    result['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(result))
+
+def run_case(args, name, lang, alphabet):
+    command = [sys.executable, '-m', 'benchmarks.run', '--worker', name, '--lang', lang, '--alphabet', alphabet or 'kanjitokana',
+               '--duration', str(args.duration), '--resolution', args.resolution, '--fps', str(args.fps),
+               '--repeat', str(args.repeat), '--render-mode', args.render_mode]
+    with tempfile.TemporaryDirectory() as cache_folder:
+        # Cold text cache and no network access
+        env = {**os.environ, 'KARAOK_TEXT_CACHE_FOLDER': cache_folder, 'KARAOK_TRANSLATION_BACKEND': 'loopback'}
+        output = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(benchmarks_folder), env=env)
+    if output.returncode != 0:
+        raise RuntimeError(f"{case_name(name, lang, alphabet)} failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def case_name(name, lang, alphabet):
+    return f"{name}[{lang}]" if alphabet is None else f"{name}[{lang}, {alphabet}]"
+
+# Regressions are slower wall times, lower frame rates and higher peak memory beyond the threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    for case, result in results.items():
+        reference = baseline.get(case)
+        if reference is None:
+            continue
+        for metric, higher_is_worse in (('wall_time', True), ('peak_rss_mb', True), ('fps', False)):
+            if metric not in result or metric not in reference or reference[metric] <= 0:
+                continue
+            change = (result[metric] - reference[metric]) / reference[metric]
+            if (change if higher_is_worse else -change) > threshold:
+                regressions.append(f"{case} {metric}: {reference[metric]:.4g} -> {result[metric]:.4g} ({100 * change:+.1f}%)")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the separation, voice detection, lyrics and render stages")
+    parser.add_argument('--duration', type=float, default=180, help="length of the synthetic songs in seconds")
+    parser.add_argument('--resolution', default='1280x720', help="video size of the render benchmarks, WIDTHxHEIGHT")
+    parser.add_argument('--fps', type=int, default=24)
+    parser.add_argument('--repeat', type=int, default=5, help="runs of the fast benchmarks, the best time is kept")
+    parser.add_argument('--render-mode', default='compositor', choices=['compositor', 'moviepy'])
+    parser.add_argument('--only', nargs='*', help="benchmarks to run, e.g. split_text render_audio")
+    parser.add_argument('--baseline', default=default_baseline)
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative change counted as a regression")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--worker', choices=list(benchmarks), help=argparse.SUPPRESS)
+    parser.add_argument('--lang', default='en', help=argparse.SUPPRESS)
+    parser.add_argument('--alphabet', default='kanjitokana', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.video_size = tuple(int(value) for value in args.resolution.lower().split('x'))
+    return args
+
+def main():
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    parameters = {'duration': args.duration, 'resolution': args.resolution, 'fps': args.fps, 'render_mode': args.render_mode}
+    results = {}
+    for name, lang, alphabet in default_cases:
+        if args.only and name not in args.only:
+            continue
+        case = case_name(name, lang, alphabet)
+        results[case] = run_case(args, name, lang, alphabet)
+        metrics = ", ".join(f"{metric} {value:.4g}" for metric, value in results[case].items())
+        print(f"{case}: {metrics}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'parameters': parameters, 'results': results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with, run with --save-baseline to create one")
+        return 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline['parameters'] != parameters:
+        print(f"The baseline was measured with {baseline['parameters']}, not comparing")
+        return 0
+
+    regressions = compare(results, baseline['results'], args.threshold)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+import numpy as np
+
+# Synthetic songs and whisper_timestamped transcripts, so every stage can be measured offline
+
+vocabulary = {
+    'en': ["love", "night", "I", "you", "dance", "tonight", "forever", "the", "heart", "is", "burning", "Baby", "we", "can", "fly", "away", "with", "me", "Never", "stop"],
+    'fr': ["amour", "nuit", "je", "tu", "danse", "ce", "soir", "toujours", "le", "coeur", "brûle", "Chérie", "on", "peut", "voler", "loin", "avec", "moi", "Jamais", "arrêter"],
+    'ja': ["君", "の", "声", "が", "聞こえる", "夜空", "に", "輝く", "星", "を", "見上げて", "愛してる", "今日", "も", "明日", "へ", "走り出す", "夢", "心", "世界"]
+}
+
+# Song made of sung lines separated by short breaths, with a longer instrumental break every few lines
+def make_transcript(duration, lang, seed=0):
+    rng = np.random.default_rng(seed)
+    words_vocabulary = vocabulary[lang]
+    joiner = "" if lang == "ja" else " "
+
+    segments = []
+    t = float(rng.uniform(5, 10))
+    while True:
+        nb_words = int(rng.integers(4, 12))
+        words = []
+        for _ in range(nb_words):
+            length = float(rng.uniform(0.2, 0.6))
+            words.append({
+                "text": words_vocabulary[int(rng.integers(len(words_vocabulary)))],
+                "start": round(t, 2),
+                "end": round(t + length, 2),
+                "confidence": round(float(rng.uniform(0.5, 1.0)), 3)
+            })
+            t += length + float(rng.uniform(0.0, 0.15))
+        if words[-1]["end"] >= duration - 1:
+            break
+
+        text = joiner.join(word["text"] for word in words)
+        segments.append({
+            "id": len(segments),
+            "seek": int(words[0]["start"] * 100) // 3000 * 3000,
+            "start": words[0]["start"],
+            "end": words[-1]["end"],
+            "text": text if lang == "ja" else " " + text,
+            "temperature": 0.0,
+            "avg_logprob": round(float(rng.uniform(-0.6, -0.1)), 3),
+            "compression_ratio": round(float(rng.uniform(1.0, 2.0)), 3),
+            "no_speech_prob": round(float(rng.uniform(0.0, 0.1)), 3),
+            "confidence": round(float(np.mean([word["confidence"] for word in words])), 3),
+            "words": words
+        })
+        t += float(rng.uniform(4, 9)) if len(segments) % 4 == 0 else float(rng.uniform(0.3, 1.5))
+
+    return {
+        "text": "".join(segment["text"] for segment in segments),
+        "segments": segments,
+        "language": lang
+    }
+
+# Stereo float32 chord progression, the instrumental stem
+def make_instrumental(duration, samplerate=44100, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * samplerate)) / float(samplerate)
+    roots = [220.0, 174.61, 261.63, 196.0]
+    chord = np.array([roots[int(i) % len(roots)] for i in t // 2])
+    mono = sum(np.sin(2 * np.pi * chord * ratio * t) for ratio in (1.0, 1.25, 1.5)) / 3.0
+    mono = 0.3 * mono + 0.01 * rng.standard_normal(len(t))
+    return np.stack([mono, mono], axis=1).astype(np.float32)
+
+# Stereo float32 tones during the words of the transcript and near silence elsewhere, the vocals stem
+def make_vocals(transcript, duration, samplerate=44100, seed=0):
+    rng = np.random.default_rng(seed)
+    mono = 0.001 * rng.standard_normal(int(duration * samplerate))
+    for segment in transcript["segments"]:
+        for word in segment["words"]:
+            start, end = int(word["start"] * samplerate), min(int(word["end"] * samplerate), len(mono))
+            if end <= start:
+                continue
+            t = np.arange(end - start) / float(samplerate)
+            envelope = np.sin(np.pi * np.arange(end - start) / (end - start))
+            mono[start:end] += 0.4 * envelope * np.sin(2 * np.pi * float(rng.uniform(200, 600)) * t)
+    return np.stack([mono, mono], axis=1).astype(np.float32)
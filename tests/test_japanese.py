@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("pykakasi")
+
+from api.japanese import Morpheme, readings, split_reading, align_romaji
+
+def words_of(texts):
+    return [{"start": float(i), "end": i + 1.0, "text": text, "confidence": 1.0} for i, text in enumerate(texts)]
+
+def aligned(texts):
+    return [(word["start"], word["end"], word["text"]) for word in align_romaji(words_of(texts))]
+
+def test_small_kana_read_with_the_syllable_before():
+    assert split_reading(readings("ちゃん")[0], [1, 1, 1]) == [(2, "cha"), (1, "n")]
+    assert aligned(["ち", "ゃ", "ん"]) == [(0.0, 2.0, "cha"), (2.0, 3.0, "n")]
+
+def test_small_tsu_read_with_the_syllable_after():
+    assert split_reading(readings("ずっと")[0], [1, 1, 1]) == [(1, "zu"), (2, "tto")]
+    assert aligned(["ず", "っ", "と"]) == [(0.0, 1.0, "zu"), (1.0, 3.0, "tto")]
+    assert aligned(["きっ", "と"]) == [(0.0, 1.0, "ki"), (1.0, 2.0, "tto")]
+
+def test_long_vowel_mark_read_with_the_syllable_before():
+    assert aligned(["ラ", "ーメン"]) == [(0.0, 1.0, "raa"), (1.0, 2.0, "men")]
+
+def test_unsplittable_reading_merges_the_words():
+    # The particle reading doesn't match the romaji of the characters read alone
+    assert split_reading(Morpheme("では", "では", "デハ", "dewa"), [1, 1]) == [(2, "dewa")]
+
+def test_kanji_compound_merges_the_words():
+    assert aligned(["東", "京"]) == [(0.0, 2.0, "toukyou")]
+
+def test_words_inside_one_morpheme_keep_their_timing():
+    assert aligned(["ちゃ", "んと"]) == [(0.0, 1.0, "cha"), (1.0, 2.0, "nto")]
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from api.timeline import HighlightTimeline
+
+# The frame by frame scan render_blue_rectangle used before HighlightTimeline
+def scan_positions(rect_dict_list, fps, frames):
+    positions = []
+    current_dict_index = 0
+    for i in range(frames):
+        rect_dict = rect_dict_list[current_dict_index]
+        is_last = current_dict_index == len(rect_dict_list) - 1
+        t = i / float(fps)
+        if t >= rect_dict["end"] and not is_last:
+            current_dict_index += 1
+        if rect_dict["start"] <= t <= rect_dict["end"]:
+            x = np.interp(t, [rect_dict["start"], rect_dict["end"]], [rect_dict["old_x"], rect_dict["new_x"]])
+        elif current_dict_index > 0:
+            x = rect_dict_list[current_dict_index - (0 if is_last else 1)]["new_x"]
+        else:
+            x = 0
+        positions.append(x)
+    return np.array(positions, dtype=np.float64)
+
+# Lines of words with short and long words, pauses and slightly overlapping timestamps like Whisper gives
+def random_song(rng):
+    rect_dict_list = []
+    t, x = rng.uniform(0, 3), 100
+    for _ in range(int(rng.integers(1, 40))):
+        if rng.random() < 0.15:
+            t, x = t + rng.uniform(0.5, 4), 100
+        length = rng.uniform(0.01, 0.05) if rng.random() < 0.5 else rng.uniform(0.1, 0.8)
+        start = round(t + rng.uniform(-0.05, 0.1), 2)
+        end = round(start + length, 2)
+        new_x = x + int(rng.integers(10, 200))
+        rect_dict_list.append({"start": start, "end": end, "old_x": x, "new_x": new_x})
+        t, x = end, new_x
+    return rect_dict_list, t + 3
+
+# Every frame is drawn at the same pixel as with the scan, also when several words end between two frames
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("fps", [10, 24, 30])
+def test_matches_frame_scan(seed, fps):
+    rng = np.random.default_rng(seed)
+    for _ in range(15):
+        rect_dict_list, duration = random_song(rng)
+        frames = int(duration * fps)
+        expected = scan_positions(rect_dict_list, fps, frames)
+        positions = HighlightTimeline.from_dicts(rect_dict_list).frame_positions(fps, 0, frames)
+        np.testing.assert_array_equal(positions.astype(np.int64), expected.astype(np.int64))
+        np.testing.assert_allclose(positions, expected)
+
+def test_random_access():
+    rect_dict_list, duration = random_song(np.random.default_rng(42))
+    frames = int(duration * 24)
+    expected = scan_positions(rect_dict_list, 24, frames)
+    timeline = HighlightTimeline.from_dicts(rect_dict_list)
+    np.testing.assert_allclose(timeline.frame_positions(24, frames // 3, frames // 2), expected[frames // 3:frames // 2])
+    for frame_index in range(frames - 1, 0, -7):
+        assert timeline.x_at_frame(frame_index, 24) == pytest.approx(expected[frame_index])
+
+def test_one_word_per_frame():
+    # Both words end before frame 1, the scan is still on the second one at frame 1 and shows the end of the first,
+    # then from frame 2 it's on the last word and shows its end before it starts
+    rect_dict_list = [
+        {"start": 0.0, "end": 0.01, "old_x": 100, "new_x": 150},
+        {"start": 0.01, "end": 0.02, "old_x": 150, "new_x": 200},
+        {"start": 0.5, "end": 1.0, "old_x": 200, "new_x": 300}
+    ]
+    timeline = HighlightTimeline.from_dicts(rect_dict_list)
+    assert list(timeline.frame_positions(10, 0, 4)) == [100, 150, 200, 300]
+    assert list(scan_positions(rect_dict_list, 10, 4)) == [100, 150, 200, 300]
+
+def test_gap_before_last_word():
+    rect_dict_list = [
+        {"start": 1.0, "end": 2.0, "old_x": 100, "new_x": 200},
+        {"start": 3.0, "end": 4.0, "old_x": 200, "new_x": 300}
+    ]
+    timeline = HighlightTimeline.from_dicts(rect_dict_list)
+    assert list(timeline.frame_positions(2, 0, 11)) == [0, 0, 100, 150, 200, 300, 200, 250, 300, 300, 300]
+
+def test_single_word():
+    timeline = HighlightTimeline.from_dicts([{"start": 1.0, "end": 2.0, "old_x": 100, "new_x": 200}])
+    assert list(timeline.frame_positions(2, 0, 6)) == [0, 0, 100, 150, 200, 0]
+
+def test_no_words():
+    assert HighlightTimeline.from_dicts([]).x_at_frame(10, 24) == 0
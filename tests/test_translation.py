@@ -0,0 +1,92 @@
+import sys
+import types
+from collections import namedtuple
+
+import pytest
+
+from api.translation import GoogleTranslateBackend, LoopbackBackend, TranslationCache, translate_texts
+
+Translated = namedtuple('Translated', ['src', 'dest', 'text'])
+
+# Stand-in for googletrans' Translator, checking the languages like googletrans 3.1.0a0 and translating line by line
+class FakeTranslator:
+    def __init__(self, languages, special_cases, drop_lines=False):
+        self.languages = languages
+        self.special_cases = special_cases
+        self.drop_lines = drop_lines
+        self.requests = []
+
+    def translate(self, text, dest='en', src='auto'):
+        if src != 'auto' and src not in self.languages and src not in self.special_cases:
+            raise ValueError('invalid source language')
+        if isinstance(text, list):
+            return [self.translate(item, dest=dest, src=src) for item in text]
+        self.requests.append(text)
+        lines = [f"<{dest}>{line}" for line in text.split("\n")]
+        if self.drop_lines and len(lines) > 1:
+            lines = lines[:-1]
+        return Translated(src, dest, "\n".join(lines))
+
+# googletrans 3.1.0a0 only exports Translator, LANGCODES and LANGUAGES at the package top
+@pytest.fixture
+def googletrans(monkeypatch):
+    languages = {'en': 'english', 'fr': 'french', 'ja': 'japanese', 'zh-cn': 'chinese (simplified)', 'zh-tw': 'chinese (traditional)'}
+    special_cases = {'ee': 'et'}
+    constants = types.ModuleType('googletrans.constants')
+    constants.LANGUAGES = languages
+    constants.LANGCODES = {name: code for code, name in languages.items()}
+    constants.SPECIAL_CASES = special_cases
+    package = types.ModuleType('googletrans')
+    package.__path__ = []
+    package.constants = constants
+    package.LANGUAGES = constants.LANGUAGES
+    package.LANGCODES = constants.LANGCODES
+    package.Translator = lambda: FakeTranslator(languages, special_cases)
+    monkeypatch.setitem(sys.modules, 'googletrans', package)
+    monkeypatch.setitem(sys.modules, 'googletrans.constants', constants)
+    return package
+
+def test_source_language(googletrans):
+    backend = GoogleTranslateBackend()
+    assert backend.source_language('ja') == 'ja'
+    assert backend.source_language('zh') == 'zh-cn'
+    assert backend.source_language('yue') == 'zh-tw'
+    assert backend.source_language('ee') == 'ee'
+    assert backend.source_language('ln') == 'auto'
+    assert backend.source_language(None) == 'auto'
+
+def test_batch_is_one_request(googletrans):
+    backend = GoogleTranslateBackend()
+    assert backend.translate_batch(["bonjour", "le\nmonde", "salut"], 'fr', 'en') == ["<en>bonjour", "<en>le monde", "<en>salut"]
+    assert backend.translator().requests == ["bonjour\nle monde\nsalut"]
+
+def test_unknown_source_language_is_detected(googletrans):
+    backend = GoogleTranslateBackend()
+    assert backend.translate_batch(["mbote"], 'ln', 'en') == ["<en>mbote"]
+
+def test_lines_translated_one_by_one_when_the_count_differs(googletrans):
+    backend = GoogleTranslateBackend()
+    backend.local.translator = FakeTranslator(googletrans.LANGUAGES, {}, drop_lines=True)
+    assert backend.translate_batch(["a", "b", "c"], 'fr', 'en') == ["<en>a", "<en>b", "<en>c"]
+    assert backend.translator().requests == ["a\nb\nc", "a", "b", "c"]
+
+class CountingBackend(LoopbackBackend):
+    def __init__(self):
+        super().__init__(tag=True)
+        self.batches = []
+
+    def translate_batch(self, texts, src, dest):
+        self.batches.append(list(texts))
+        return super().translate_batch(texts, src, dest)
+
+def test_translate_texts_batches_and_caches():
+    backend = CountingBackend()
+    cache = TranslationCache(100)
+    texts = ["one", "two", "one", "three", "four", "five"]
+    assert translate_texts(texts, 'en', 'fr', backend=backend, cache=cache, batch_size=2, max_workers=2) == [f"[fr] {text}" for text in texts]
+    assert sorted(map(tuple, backend.batches)) == [("five",), ("one", "two"), ("three", "four")]
+
+    backend.batches = []
+    assert translate_texts(["two", "six"], 'en', 'fr', backend=backend, cache=cache, batch_size=2) == ["[fr] two", "[fr] six"]
+    assert backend.batches == [["six"]]
+    assert cache.stats()['hits'] == 1
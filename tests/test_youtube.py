@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from api import youtube
+
+# Stand-in for yt_dlp.YoutubeDL, writing a small file instead of downloading
+class FakeExtractor:
+    instances = []
+
+    def __init__(self, options):
+        self.options = options
+        self.extract_calls = []
+        self.process_calls = 0
+        FakeExtractor.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def extract_info(self, url, download=True):
+        self.extract_calls.append((url, download))
+        return {'id': 'dQw4w9WgXcQ', 'title': 'Some: Song/Title', 'ext': 'webm'}
+
+    def process_ie_result(self, info, download=True):
+        self.process_calls += 1
+        filepath = self.prepare_filename(info)
+        with open(filepath, "wb") as f:
+            f.write(b"audio")
+        return {**info, 'requested_downloads': [{'filepath': filepath}]}
+
+    def prepare_filename(self, info):
+        return self.options['outtmpl'].replace('%(id)s', info['id']).replace('%(ext)s', info['ext'])
+
+@pytest.fixture(autouse=True)
+def upload_folder(tmp_path, monkeypatch):
+    folder = str(tmp_path) + os.sep
+    monkeypatch.setattr(youtube, 'upload_folder', folder)
+    monkeypatch.setattr(youtube, 'youtube_folder', os.path.join(folder, 'youtube/'))
+    FakeExtractor.instances = []
+    return folder
+
+def test_single_extraction_without_transcode(upload_folder):
+    filename, title = youtube.download_youtube_audio("https://www.youtube.com/watch?v=dQw4w9WgXcQ", extractor=FakeExtractor)
+
+    assert len(FakeExtractor.instances) == 1
+    ydl = FakeExtractor.instances[0]
+    assert ydl.extract_calls == [("https://www.youtube.com/watch?v=dQw4w9WgXcQ", False)]
+    assert ydl.process_calls == 1
+    assert 'postprocessors' not in ydl.options
+    assert filename == os.path.join('youtube', 'dQw4w9WgXcQ.webm')
+    assert title == 'Some_ Song_Title'
+    assert os.path.exists(os.path.join(upload_folder, filename))
+
+def test_cached_for_both_link_forms():
+    first = youtube.download_youtube_audio("https://www.youtube.com/watch?v=dQw4w9WgXcQ", extractor=FakeExtractor)
+    assert len(FakeExtractor.instances) == 1
+
+    assert youtube.download_youtube_audio("https://youtu.be/dQw4w9WgXcQ", extractor=FakeExtractor) == first
+    assert youtube.download_youtube_audio("https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=42", extractor=FakeExtractor) == first
+    assert len(FakeExtractor.instances) == 1
+    assert len(FakeExtractor.instances[0].extract_calls) == 1
+
+def test_downloaded_again_when_the_file_is_gone(upload_folder):
+    filename, _ = youtube.download_youtube_audio("https://youtu.be/dQw4w9WgXcQ", extractor=FakeExtractor)
+    os.remove(os.path.join(upload_folder, filename))
+
+    youtube.download_youtube_audio("https://youtu.be/dQw4w9WgXcQ", extractor=FakeExtractor)
+    assert len(FakeExtractor.instances) == 2
+    assert FakeExtractor.instances[1].process_calls == 1